@@ -3,28 +3,36 @@
 
 Usage:
 
-    movies_report store report subset
+    movies_report [--compact] store report subset
 
 Args:
-    store   JSON file with movie data
+    store   JSON, JSON Lines or SQLite file with movie data, JSON may be gzip,
+            bzip2 or xz compressed
     report  
         movielist   Alphabetical list of movies
-
+    subset  all, or comma separated FIELD=VALUE terms that all must match
+        category=CATEGORY
+        audio=LANGUAGE
+        subtitle=LANGUAGE
+        media-location=LOCATION
+        media-type=disc|file
+        year=YEAR or year=FIRST-LAST
+    --compact
+            Keep movies as compact records instead of dicts, uses a fraction
+            of the memory
+
+Example:
+
+    movies_report movies.json movielist category=sf,audio=en,year=1980-1989
 """
 
+import argparse
+import bisect
+import os
 import sys
-import json
-import functools
-from datetime import datetime, date, time, timedelta
-
 
-def datetime_parser(json_dict):
-    for (key, value) in json_dict.items():
-        try:
-            json_dict[key] = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
-        except (ValueError, AttributeError, TypeError):
-            pass
-    return json_dict
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import jsonstore, records
 
 
 def date_handler(obj):
@@ -37,6 +45,7 @@ def date_handler(obj):
 
 
 def movielist(store):
+    """Movies with default values for missing fields, the movies of store are updated."""
     movies = list()
     for movie in store:
         # Add default values
@@ -46,53 +55,135 @@ def movielist(store):
             movie["comment"] = ""
         if not "category" in movie:
             movie["category"] = ["-"]
-        m = {"media-title": movie["title"],
-             "media-location": movie["media-location"],
-             "media-type": movie["media-type"],
-             "media-format": movie["media-format"],
-             "media-audio": movie["audio"],
-             "media-subtitle": movie["subtitle"],
-             "media-comment": movie["comment"],
-             "media-production-year": movie["production-year"],
-             "media-category": movie["category"]}
         # if movie["title"] in movies:
         #     print("{} already exists, skipping this one.".format(movie["title"]))
         #     continue
-        movies.append(m)
+        movies.append(movie)
     return movies
 
 
-def main(store, report, subset):
-    items = json.load(open(store, 'r', encoding="utf-8"), object_hook=datetime_parser)
+# Subset fields with an inverted index
+INDEXED_FIELDS = ("category", "audio", "subtitle", "media-location", "media-type")
+
+
+def parse_subset(subset):
+    """Parse a subset argument into a list of (field, value) terms.
+
+    Years are parsed into an inclusive (first, last) range. Raises ValueError
+    for unknown fields and malformed years.
+    """
+    if subset == "all":
+        return []
+    terms = list()
+    for term in subset.split(","):
+        (field, equals, value) = term.partition("=")
+        if field == "year" and equals:
+            (first, _, last) = value.partition("-")
+            terms.append((field, (int(first), int(last or first))))
+        elif field in INDEXED_FIELDS and equals:
+            terms.append((field, value))
+        else:
+            raise ValueError("Unknown subset term: {}".format(term))
+    return terms
+
+
+class MovieIndex:
+    """Movies in report order with inverted indexes for subset queries.
+
+    Movies are sorted once on title and production year, so a position in
+    movies is also the rank of the movie, and a sorted list of positions is
+    a list in report order.
+    """
+
+    def __init__(self, movies):
+        self.movies = sorted(movies, key=lambda movie: (movie["title"],
+                                                        str(movie["production-year"])))
+        self.index = {field: dict() for field in INDEXED_FIELDS}
+        years = list()
+        for (position, movie) in enumerate(self.movies):
+            for field in INDEXED_FIELDS:
+                values = movie[field]
+                for value in values if isinstance(values, list) else [values]:
+                    try:
+                        self.index[field][value].append(position)
+                    except KeyError:
+                        self.index[field][value] = [position]
+            # Unknown years are -1 or 0, and years from movielists are strings
+            try:
+                year = int(movie["production-year"])
+            except (TypeError, ValueError):
+                continue
+            if year > 0:
+                years.append((year, position))
+        years.sort()
+        self.years = [year for (year, _) in years]
+        self.year_positions = [position for (_, position) in years]
+
+    def positions(self, field, value):
+        """Positions of the movies matching one term."""
+        if field == "year":
+            (first, last) = value
+            return self.year_positions[bisect.bisect_left(self.years, first):
+                                       bisect.bisect_right(self.years, last)]
+        return self.index[field].get(value, [])
+
+    def select(self, terms):
+        """Movies matching all terms, in report order."""
+        if not terms:
+            return self.movies
+        postings = sorted((self.positions(field, value) for (field, value) in terms), key=len)
+        selected = set(postings[0])
+        for positions in postings[1:]:
+            if not selected:
+                break
+            selected.intersection_update(positions)
+        return [self.movies[position] for position in sorted(selected)]
+
+
+def main(store, report, subset, compact=False):
+    terms = parse_subset(subset)
+    items = jsonstore.iter_records(store)
+    if compact:
+        items = [records.Movie.from_dict(movie) for movie in items]
     movies = list()
     if report == "movielist":
         movies = movielist(items)
 
-    movies.sort(key=lambda movie: "{} {}".format(movie["media-title"], movie["media-production-year"]))
-    for movie in movies:
-        if movie["media-production-year"] == -1:
+    for movie in MovieIndex(movies).select(terms):
+        if movie["production-year"] == -1:
             print("{}\t{}\t{}/{}\t{}/{}\t{}".
                 format(movie["media-location"],
-                        movie["media-title"],
-                        movie["media-audio"],
-                        movie["media-subtitle"],
+                        movie["title"],
+                        movie["audio"],
+                        movie["subtitle"],
                         movie["media-type"],
                         movie["media-format"],
-                        movie["media-category"]))
+                        movie["category"]))
         else:
             print("{}\t{} ({})\t{}/{}\t{}/{}\t{}".
                 format(movie["media-location"],
-                        movie["media-title"],
-                        movie["media-production-year"],
-                        movie["media-audio"],
-                        movie["media-subtitle"],
+                        movie["title"],
+                        movie["production-year"],
+                        movie["audio"],
+                        movie["subtitle"],
                         movie["media-type"],
                         movie["media-format"],
-                        movie["media-category"]))
+                        movie["category"]))
 
 
 if __name__ == '__main__':
-    if len(sys.argv) == 4:
-        main(sys.argv[1], sys.argv[2], sys.argv[3])
-    else:
-        print("{}".format(__doc__))
+    parser = argparse.ArgumentParser(description='Extract information from movie data')
+    parser.add_argument("store", help="JSON, JSON Lines or SQLite file with movie data, "
+                        "JSON may be gzip, bzip2 or xz compressed")
+    parser.add_argument("report", help="movielist, alphabetical list of movies")
+    parser.add_argument("subset", help="all, or comma separated FIELD=VALUE terms that all "
+                        "must match, FIELD is category, audio, subtitle, media-location, "
+                        "media-type or year, year=FIRST-LAST for a range")
+    parser.add_argument("--compact", help="Keep movies as compact records instead of dicts, "
+                        "uses a fraction of the memory", action='store_true')
+    args = parser.parse_args()
+    try:
+        parse_subset(args.subset)
+    except ValueError as ex:
+        parser.error(str(ex))
+    main(args.store, args.report, args.subset, args.compact)
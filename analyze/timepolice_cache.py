@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""On-disk cache of timesheet results for timepolice_report.
+
+The summaries of each day, week or month are cached under a key of the
+store fingerprint (path, size and mtime), a digest of the distribution, the
+project and the dates the period spans. Queries with overlapping date
+ranges reuse the periods they have in common without loading the store.
+A period the query only covers partly, at its first or last date, is keyed
+on a digest of its sessions and task entries as well. The periods of each
+query are cached too, so repeating a query does not even load the store.
+
+Entries are kept in an SQLite file, least recently used entries are evicted
+when it grows beyond its size limit, and entries of a store that has since
+changed are removed when the store is next queried.
+
+Usage:
+
+    cache = TimesheetCache("timesheet.cache")
+    timesheet(cache, 'store.json', load_index, '19-06-01', '19-12-31', distributionitems,
+              'Kostnad', 'weekly')
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from datetime import date, datetime, timedelta
+
+import timepolice_report
+
+MAX_SIZE = 64*1024*1024
+MICROSECOND = timedelta(microseconds=1)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    store TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_store ON entries (store);
+CREATE INDEX IF NOT EXISTS entries_used ON entries (used);
+"""
+
+
+def digest(*parts):
+    return hashlib.sha256(json.dumps(parts, default=str).encode('utf8')).hexdigest()
+
+
+def store_fingerprint(path):
+    """Absolute path and a fingerprint that changes when the store is rewritten."""
+    st = os.stat(path)
+    return (os.path.abspath(path), "{}:{}".format(st.st_size, st.st_mtime_ns))
+
+
+def session_digest(sessions):
+    """Digest identifying a run of sessions of one project in a store."""
+    return digest([(s['date_created'], s['date_ingested'], s['isongoing'],
+                    [(t['taskname'], t['start'], t['stop']) for t in s['taskentries']])
+                   for s in sessions])
+
+
+class TimesheetCache:
+    """Size bounded LRU cache of JSON values in an SQLite file.
+
+    All changes of one run are committed together when the cache is closed.
+    """
+
+    def __init__(self, path, max_size=MAX_SIZE):
+        self.max_size = max_size
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.executescript(SCHEMA)
+
+    def invalidate(self, store, fingerprint):
+        """Remove the entries of earlier versions of store."""
+        self.db.execute("DELETE FROM entries WHERE store = ? AND fingerprint != ?",
+                        (store, fingerprint))
+
+    def get(self, key):
+        row = self.db.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute("UPDATE entries SET used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, value, store, fingerprint):
+        text = json.dumps(value, ensure_ascii=False)
+        self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                        (key, store, fingerprint, text, len(text), time.time()))
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_size."""
+        (total,) = self.db.execute("SELECT coalesce(sum(size), 0) FROM entries").fetchone()
+        if total <= self.max_size:
+            return
+        for (key, size) in self.db.execute("SELECT key, size FROM entries ORDER BY used")\
+                .fetchall():
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_size:
+                break
+
+    def close(self):
+        self.evict()
+        self.db.commit()
+        self.db.close()
+
+
+def split_periods(sessions, period):
+    """Split sessions into the periods timepolice_report.timesheet sums separately."""
+    spans = list()
+    start = 0
+    old_session_created = ()
+    for (i, session) in enumerate(sessions):
+        if timepolice_report.period_done(old_session_created, session['date_created'], period):
+            spans.append(sessions[start:i])
+            start = i
+        old_session_created = session['date_created']
+    spans.append(sessions[start:])
+    return spans
+
+
+def calendar_periods(first, last, period):
+    """The days, ISO weeks or months from date ordinal first to last.
+
+    Returns:
+        A list of (start, end, partial), the first and last date ordinal of
+        each period within first and last, and whether the query only covers
+        part of it.
+    """
+    periods = list()
+    day = first
+    while day <= last:
+        if period == 'daily':
+            (start, end) = (day, day)
+        elif period == 'weekly':
+            start = day - date.fromordinal(day).weekday()
+            end = start + 6
+        else:
+            month = date.fromordinal(day).replace(day=1)
+            start = month.toordinal()
+            end = (month + timedelta(days=32)).replace(day=1).toordinal() - 1
+        periods.append((max(start, first), min(end, last), start < first or end > last))
+        day = end + 1
+    return periods
+
+
+def period_spans(sessions, compiled, period):
+    """Cache value of the sessions of one calendar period.
+
+    A list with, for each period timepolice_report.timesheet sums separately,
+    its first and last date and time per task in microseconds.
+    """
+    spans = list()
+    for span in split_periods(sessions, period) if sessions else []:
+        summary = dict()
+        for session in span:
+            timepolice_report.append_session_summary(summary, session, compiled)
+        spans.append({'first': span[0]['date_created'].isoformat(),
+                      'last': span[-1]['date_created'].isoformat(),
+                      'tasks': [[task, spent // MICROSECOND] for (task, spent) in summary.items()]})
+    return spans
+
+
+def join_spans(periods, period):
+    """Join the spans of consecutive calendar periods into the periods of timesheet.
+
+    period_done only compares week or month numbers, so timesheet sums e.g.
+    the same week of two years together when there are no sessions between.
+
+    Returns:
+        A list of (last date, summary) to print.
+    """
+    joined = list()
+    previous = ()
+    for spans in periods:
+        for span in spans:
+            first = datetime.fromisoformat(span['first'])
+            if not joined or timepolice_report.period_done(previous, first, period):
+                joined.append((None, dict()))
+            summary = joined[-1][1]
+            for (task, microseconds) in span['tasks']:
+                timepolice_report.add_task(summary, task, timedelta(microseconds=microseconds))
+            previous = datetime.fromisoformat(span['last'])
+            joined[-1] = (previous, summary)
+    return joined
+
+
+def timesheet(cache, store, load_index, first_date, last_date, distribution, project, period):
+    """timepolice_report.timesheet answered from cache where possible.
+
+    Each day, week or month that the query covers completely is cached
+    under the dates it spans, so it is served without loading the store.
+    The partly covered periods at the ends of the query are cached under
+    a digest of their sessions as well, and the period keys of each query
+    under the query, so an exact repeat does not load the store either.
+
+    Args:
+        cache:          TimesheetCache
+        store:          Path of the store
+        load_index:     Function returning the project index of the store, only
+                        called when the query is not cached
+        others:         As for timepolice_report.timesheet
+    """
+    (path, fingerprint) = store_fingerprint(store)
+    cache.invalidate(path, fingerprint)
+    distribution_key = digest(distribution)
+    query = digest('query', path, fingerprint, distribution_key, project, first_date, last_date,
+                   period)
+    periods = None
+    keys = cache.get(query)
+    if keys is not None:
+        periods = [cache.get(key) for key in keys]
+        if None in periods:
+            periods = None
+
+    index = None
+    if periods is None:
+        first = datetime.strptime(first_date, "%y-%m-%d").date().toordinal()
+        last = datetime.strptime(last_date, "%y-%m-%d").date().toordinal()
+        compiled = None
+        keys = list()
+        periods = list()
+        for (start, end, partial) in calendar_periods(first, last, period):
+            key = digest('period', path, fingerprint, distribution_key, project, period, start,
+                         end)
+            sessions = None
+            if partial:
+                if index is None:
+                    index = load_index()
+                sessions = timepolice_report.sessions_between_dates(index, project, start, end)
+                key = digest(key, session_digest(sessions))
+            spans = cache.get(key)
+            if spans is None:
+                if index is None:
+                    index = load_index()
+                if sessions is None:
+                    sessions = timepolice_report.sessions_between_dates(index, project, start,
+                                                                        end)
+                if compiled is None:
+                    compiled = timepolice_report.compile_distribution(distribution)
+                spans = period_spans(sessions, compiled, period)
+                cache.put(key, spans, path, fingerprint)
+            keys.append(key)
+            periods.append(spans)
+        cache.put(query, keys, path, fingerprint)
+
+    joined = join_spans(periods, period)
+    if not joined:
+        # No sessions, as timesheet does
+        return timepolice_report.timesheet(index if index is not None else load_index(),
+                                           first_date, last_date, distribution, project, period)
+    total_seconds = 0
+    for (last, summary) in joined:
+        total_seconds = total_seconds + timepolice_report.print_summary(
+            "Last date included", last, summary)
+    print("Total: {}".format(round(total_seconds/3600, 2)))
+    print()
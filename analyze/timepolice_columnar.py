@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""Columnar timesheet engine for timepolice data, requires NumPy.
+
+Task entries are kept in flat arrays instead of one dict per entry:
+
+    sessions:   project code, date_created (seconds), first and last task entry
+    entries:    start and stop (seconds), task code
+
+where seconds are counted from the start of date ordinal 0. Sums per period
+and task are computed with vectorised group-by operations, the result is
+printed through timepolice_report.print_summary so the output is identical
+to the dict based engine.
+
+Usage:
+
+    table = TaskTable.from_store(storeitems)
+    timesheet(table, '19-06-01', '19-12-31', distributionitems, 'Kostnad', 'weekly')
+"""
+
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import timepolice_report
+
+SECONDS_PER_DAY = 86400
+EPOCH_ORDINAL = 719163  # date(1970, 1, 1).toordinal()
+
+
+def to_seconds(dt):
+    return dt.toordinal()*SECONDS_PER_DAY + dt.hour*3600 + dt.minute*60 + dt.second
+
+
+def from_seconds(seconds):
+    seconds = int(seconds)
+    return datetime.fromordinal(seconds // SECONDS_PER_DAY) + \
+        timedelta(seconds=seconds % SECONDS_PER_DAY)
+
+
+class TaskTable:
+    """Sessions and task entries of a timepolice store as NumPy arrays.
+
+    Sessions are ordered on (project, date_created), keeping store order for
+    equal keys, which is the order timepolice_report.build_project_index uses.
+    """
+
+    def __init__(self, projects, tasks, session_project, session_created,
+                 session_first, session_count, entry_start, entry_stop, entry_task):
+        self.projects = projects
+        self.project_codes = {name: code for (code, name) in enumerate(projects)}
+        self.tasks = tasks
+        self.task_codes = {name: code for (code, name) in enumerate(tasks)}
+
+        order = np.lexsort((session_created, session_project))
+        self.session_project = session_project[order]
+        self.session_created = session_created[order]
+        self.session_ordinal = self.session_created // SECONDS_PER_DAY
+        self.session_first = session_first[order]
+        self.session_count = session_count[order]
+
+        self.entry_start = entry_start
+        self.entry_stop = entry_stop
+        self.entry_task = entry_task
+
+    @classmethod
+    def from_store(cls, store):
+        """Build a table from session dicts with datetime values."""
+        projects = dict()
+        tasks = dict()
+        session_project = list()
+        session_created = list()
+        session_first = list()
+        session_count = list()
+        entry_start = list()
+        entry_stop = list()
+        entry_task = list()
+        for session in store:
+            session_project.append(projects.setdefault(session['projectname'], len(projects)))
+            session_created.append(to_seconds(session['date_created']))
+            session_first.append(len(entry_task))
+            session_count.append(len(session['taskentries']))
+            for taskentry in session['taskentries']:
+                entry_start.append(to_seconds(taskentry['start']))
+                entry_stop.append(to_seconds(taskentry['stop']))
+                entry_task.append(tasks.setdefault(taskentry['taskname'], len(tasks)))
+        return cls(list(projects), list(tasks),
+                   np.array(session_project, dtype=np.int32),
+                   np.array(session_created, dtype=np.int64),
+                   np.array(session_first, dtype=np.int64),
+                   np.array(session_count, dtype=np.int64),
+                   np.array(entry_start, dtype=np.int64),
+                   np.array(entry_stop, dtype=np.int64),
+                   np.array(entry_task, dtype=np.int32))
+
+    def sessions_between_dates(self, projectname, startdate, enddate):
+        """Positions of the sessions of a project created from startdate to enddate."""
+        if projectname not in self.project_codes:
+            return np.arange(0)
+        code = self.project_codes[projectname]
+        lo = np.searchsorted(self.session_project, code, side='left')
+        hi = np.searchsorted(self.session_project, code, side='right')
+        ordinals = self.session_ordinal[lo:hi]
+        return np.arange(lo + np.searchsorted(ordinals, startdate, side='left'),
+                         lo + np.searchsorted(ordinals, enddate, side='right'))
+
+    def entries_of(self, sessions):
+        """Positions of the task entries of sessions, in session order."""
+        counts = self.session_count[sessions]
+        ends = np.cumsum(counts)
+        return np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends-counts, counts) + \
+            np.repeat(self.session_first[sessions], counts)
+
+
+def iso_weeks(ordinals):
+    """ISO week numbers of an array of date ordinals."""
+    weekday = (ordinals - 1) % 7
+    thursday = (ordinals - weekday + 3 - EPOCH_ORDINAL).astype('datetime64[D]')
+    january_1 = thursday.astype('datetime64[Y]').astype('datetime64[D]')
+    return (thursday - january_1).astype(np.int64) // 7 + 1
+
+
+def period_ids(ordinals, period):
+    """Period number of each session, vectorised version of timepolice_report.period_done."""
+    if len(ordinals) == 0:
+        return np.arange(0)
+    if period == 'daily':
+        return np.arange(len(ordinals))
+    elif period == 'weekly':
+        keys = iso_weeks(ordinals)
+    elif period == 'monthly':
+        months = (ordinals - EPOCH_ORDINAL).astype('datetime64[D]').astype('datetime64[M]')
+        keys = months.astype(np.int64) % 12
+    else:
+        return np.zeros(len(ordinals), dtype=np.int64)
+    done = np.empty(len(keys), dtype=bool)
+    done[0] = False
+    done[1:] = keys[1:] != keys[:-1]
+    return np.cumsum(done)
+
+
+def scale_microseconds(microseconds, amounts):
+    """Same as timedelta(microseconds=m) * amount, rounding half to even."""
+    product = microseconds * amounts
+    scaled = np.rint(product).astype(np.int64)
+    # Products close to a tie may round the wrong way in floating point,
+    # recompute those exactly the way timedelta does
+    close = np.abs(product - np.floor(product) - 0.5) < 1e-3
+    for i in np.flatnonzero(close):
+        scaled[i] = (timedelta(microseconds=int(microseconds[i])) * float(amounts[i])) \
+            // timedelta(microseconds=1)
+    return scaled
+
+
+def distribute(table, entries, compiled):
+    """Apply distribution rules to task entries.
+
+    Returns:
+        (entry, task, microseconds) arrays, with one row per task that an
+        entry adds time to, in the order append_session_summary adds them.
+    """
+    (start_dates, rules) = compiled
+    starts = table.entry_start[entries]
+    tasks = table.entry_task[entries]
+    microseconds = (table.entry_stop[entries] - starts) * 1000000
+    rule_starts = np.array([to_seconds(d) for d in start_dates], dtype=np.int64)
+    rule = np.searchsorted(rule_starts, starts, side='left') - 1
+
+    ntasks = len(table.tasks)
+    pairs, inverse = np.unique((rule + 1) * ntasks + tasks, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    target_task = list()
+    target_amount = list()
+    target_offset = list()
+    target_count = list()
+    for pair in pairs.tolist():
+        (r, task) = divmod(pair, ntasks)
+        name = table.tasks[task]
+        targets = rules[r-1].get(name) if r > 0 else None
+        target_offset.append(len(target_task))
+        if targets is None:
+            target_task.append(task)
+            target_amount.append(np.nan)
+            target_count.append(1)
+        else:
+            for (new_task, new_amount) in targets:
+                if new_task not in table.task_codes:
+                    table.task_codes[new_task] = len(table.tasks)
+                    table.tasks.append(new_task)
+                target_task.append(table.task_codes[new_task])
+                target_amount.append(new_amount)
+            target_count.append(len(targets))
+
+    counts = np.array(target_count, dtype=np.int64)[inverse]
+    ends = np.cumsum(counts)
+    row_entry = np.repeat(np.arange(len(entries)), counts)
+    row_target = np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends-counts, counts) + \
+        np.repeat(np.array(target_offset, dtype=np.int64)[inverse], counts)
+    row_task = np.array(target_task, dtype=np.int64)[row_target]
+    row_amount = np.array(target_amount, dtype=np.float64)[row_target]
+    row_microseconds = microseconds[row_entry]
+    weighted = ~np.isnan(row_amount)
+    row_microseconds[weighted] = scale_microseconds(row_microseconds[weighted],
+                                                    row_amount[weighted])
+    return (row_entry, row_task, row_microseconds)
+
+
+def timesheet(table, first_date, last_date, distribution, project, period):
+    first = datetime.strptime(first_date, "%y-%m-%d").date().toordinal()
+    last = datetime.strptime(last_date, "%y-%m-%d").date().toordinal()
+    sessions = table.sessions_between_dates(project, first, last)
+    compiled = timepolice_report.compile_distribution(distribution)
+
+    session_period = period_ids(table.session_ordinal[sessions], period)
+    entries = table.entries_of(sessions)
+    entry_period = np.repeat(session_period, table.session_count[sessions])
+    (row_entry, row_task, row_microseconds) = distribute(table, entries, compiled)
+    row_period = entry_period[row_entry]
+
+    # Sum per (period, task), keeping the order in which tasks first appear
+    ntasks = len(table.tasks)
+    keys, first_row, inverse = np.unique(row_period * ntasks + row_task, return_index=True,
+                                         return_inverse=True)
+    sums = np.bincount(inverse.reshape(-1), weights=row_microseconds,
+                       minlength=len(keys)).astype(np.int64)
+    order = np.argsort(first_row, kind='stable')
+
+    # Last session of each period
+    last_created = dict()
+    for (p, created) in zip(session_period.tolist(), table.session_created[sessions].tolist()):
+        last_created[p] = created
+
+    total_seconds = 0
+    summary = dict()
+    current = None
+    for i in order.tolist():
+        (p, task) = divmod(int(keys[i]), ntasks)
+        if p != current:
+            if current is not None:
+                total_seconds = total_seconds + timepolice_report.print_summary(
+                    "Last date included", from_seconds(last_created[current]), summary)
+            summary = dict()
+            current = p
+        summary[table.tasks[task]] = timedelta(microseconds=int(sums[i]))
+    if current is not None:
+        total_seconds = total_seconds + timepolice_report.print_summary(
+            "Last date included", from_seconds(last_created[current]), summary)
+    print("Total: {}".format(round(total_seconds/3600, 2)))
+    print()
@@ -1,19 +1,15 @@
 #!/usr/bin/env python3
 
 import argparse
+import bisect
+import os
 import sys
 import json
 import functools
-from datetime import datetime, date, time, timedelta
+from datetime import datetime
 
-
-def datetime_parser(json_dict):
-    for (key, value) in json_dict.items():
-        try:
-            json_dict[key] = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
-        except (ValueError, AttributeError, TypeError):
-            pass
-    return json_dict
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import jsonstore, records, sqlitestore
 
 
 def date_handler(obj):
@@ -25,11 +21,33 @@ def date_handler(obj):
         raise TypeError('Object of type %s with value of %s is not JSON serializable' % (type(obj), repr(obj)))
 
 
-def session_between_dates(session, projectname, startdate, enddate):
-    if session['projectname'] == projectname and session['date_created'].date().toordinal() >= startdate and session['date_created'].date().toordinal() <= enddate:
-        return True
-    else:
-        return False
+def build_project_index(store):
+    """Group sessions per project, each group sorted on date_created.
+
+    Returns:
+        A dict from projectname to (ordinals, sessions), where ordinals[i] is
+        the date ordinal of sessions[i]. Sessions created on the same date keep
+        their store order.
+    """
+    projects = dict()
+    for session in store:
+        try:
+            projects[session['projectname']].append(session)
+        except KeyError:
+            projects[session['projectname']] = [session]
+    index = dict()
+    for projectname, sessions in projects.items():
+        sessions.sort(key=lambda session: session['date_created'])
+        index[projectname] = ([s['date_created'].date().toordinal() for s in sessions], sessions)
+    return index
+
+
+def sessions_between_dates(index, projectname, startdate, enddate):
+    """Sessions of a project created from startdate to enddate, both date ordinals."""
+    if projectname not in index:
+        return []
+    (ordinals, sessions) = index[projectname]
+    return sessions[bisect.bisect_left(ordinals, startdate):bisect.bisect_right(ordinals, enddate)]
 
 
 def add_task(summary, name, time):
@@ -38,40 +56,58 @@ def add_task(summary, name, time):
     except KeyError:
         summary[name] = time
 
-def get_distribution(distributions, start):
-    dist = []
-    for d in reversed(distributions):
-        if d['start_date'] < start:
-            dist = d['distribution']
-            break
-    return dist
+def compile_distribution(distributions):
+    """Compile the distribution JSON for fast lookup.
 
-def append_session_summary(summary, session, distributions):
+    Rules are sorted on start_date, for each rule the first entry for an
+    origin_task maps it to its list of (new_task, new_amount).
+
+    Returns:
+        (start_dates, rules) where rules[i] applies from start_dates[i].
+    """
+    ordered = sorted(distributions, key=lambda d: d['start_date'])
+    start_dates = [d['start_date'] for d in ordered]
+    rules = list()
+    for d in ordered:
+        targets = dict()
+        for origin in d['distribution']:
+            if origin['origin_task'] not in targets:
+                targets[origin['origin_task']] = [(new['new_task'], new['new_amount'])
+                                                  for new in origin['distribute_as']]
+        rules.append(targets)
+    return (start_dates, rules)
+
+
+def get_distribution(compiled, start):
+    """The rule of the latest start_date before start, as a dict from origin_task."""
+    (start_dates, rules) = compiled
+    i = bisect.bisect_left(start_dates, start)
+    if i == 0:
+        return {}
+    return rules[i-1]
+
+def append_session_summary(summary, session, compiled):
     for taskentry in session['taskentries']:
         name = taskentry['taskname']
-        distribution = get_distribution(distributions, taskentry['start'])
+        distribution = get_distribution(compiled, taskentry['start'])
         totaltime = taskentry['stop']-taskentry['start']
-        found = False
-        for origin in distribution:
-            if origin['origin_task'] == name:
-                for new in origin['distribute_as']:
-                    add_task(summary, new['new_task'], totaltime * new['new_amount'])
-                found = True
-                break
-        if found == False:
+        if name in distribution:
+            for (new_task, new_amount) in distribution[name]:
+                add_task(summary, new_task, totaltime * new_amount)
+        else:
             add_task(summary, name, totaltime)
 
-def print_summary(summary_text, last_date_included, summary):
+def print_summary(summary_text, last_date_included, summary, out=None):
     totals = [s for s in summary.values()]
 
     for task in summary:
-        print(task, round(summary[task].total_seconds()/3600, 2))
+        print(task, round(summary[task].total_seconds()/3600, 2), file=out)
 
     if(len(totals) > 0):
         totalseconds = functools.reduce(lambda x, y: x+y, totals).total_seconds()
         (_,week,_) = last_date_included.isocalendar()
-        print("{} {} (week {}) ===> {}".format(summary_text, last_date_included, week, round(totalseconds/3600, 2)))
-        print()
+        print("{} {} (week {}) ===> {}".format(summary_text, last_date_included, week, round(totalseconds/3600, 2)), file=out)
+        print(file=out)
         return totalseconds
 
     return 0
@@ -95,10 +131,11 @@ def period_done(old_session_created, current_session_created, period):
             return False
 
 
-def timesheet(store, first_date, last_date, distribution, project, period):
+def timesheet(index, first_date, last_date, distribution, project, period):
     first = datetime.strptime(first_date, "%y-%m-%d").date().toordinal()
     last = datetime.strptime(last_date, "%y-%m-%d").date().toordinal()
-    subset_kostnad = [s for s in store if session_between_dates(s, project, first, last)]
+    subset_kostnad = sessions_between_dates(index, project, first, last)
+    compiled = compile_distribution(distribution)
     summary = dict()
     old_session_created = ()
     total_seconds = 0
@@ -107,13 +144,79 @@ def timesheet(store, first_date, last_date, distribution, project, period):
             period_seconds = print_summary("Last date included", old_session_created, summary)
             total_seconds = total_seconds + period_seconds
             summary = dict()
-        append_session_summary(summary, session, distribution)
+        append_session_summary(summary, session, compiled)
         old_session_created = session['date_created']
     period_seconds = print_summary("Last date included", subset_kostnad[-1]['date_created'], summary)
     total_seconds = total_seconds + period_seconds
     print("Total: {}".format(round(total_seconds/3600, 2)))
     print()
-        
+
+
+def period_summaries(sessions, compiled, periods):
+    """Sum the sessions of one project for several periods in one pass.
+
+    Each session is summarised once with append_session_summary and added
+    to the running summary of every period, so the sums are those timesheet
+    computes for each period separately.
+
+    Returns:
+        A dict from period to a list of (last_date_included, summary).
+    """
+    done = {period: list() for period in periods}
+    summaries = {period: dict() for period in periods}
+    old_session_created = ()
+    for session in sessions:
+        for period in periods:
+            if(period_done(old_session_created, session['date_created'], period)):
+                done[period].append((old_session_created, summaries[period]))
+                summaries[period] = dict()
+        session_summary = dict()
+        append_session_summary(session_summary, session, compiled)
+        for summary in summaries.values():
+            for (name, time) in session_summary.items():
+                add_task(summary, name, time)
+        old_session_created = session['date_created']
+    if sessions:
+        for period in periods:
+            done[period].append((old_session_created, summaries[period]))
+    return done
+
+
+def print_timesheet(summaries, out=None):
+    """Print the (last_date_included, summary) list of a period as timesheet does."""
+    total_seconds = 0
+    for (last_date_included, summary) in summaries:
+        total_seconds = total_seconds + print_summary("Last date included", last_date_included,
+                                                      summary, out)
+    print("Total: {}".format(round(total_seconds/3600, 2)), file=out)
+    print(file=out)
+
+
+def timesheets(index, first_date, last_date, distribution, periods, output_dir=None):
+    """Timesheets of all projects with sessions in the date range, for each of periods.
+
+    Each project's sessions are scanned once for all periods. The timesheet
+    of a project and period is written to output_dir as PROJECT_PERIOD.txt,
+    identical to what timesheet prints for it, or printed under a
+    "== PROJECT PERIOD ==" heading when output_dir is None.
+    """
+    first = datetime.strptime(first_date, "%y-%m-%d").date().toordinal()
+    last = datetime.strptime(last_date, "%y-%m-%d").date().toordinal()
+    compiled = compile_distribution(distribution)
+    for project in sorted(index):
+        sessions = sessions_between_dates(index, project, first, last)
+        if not sessions:
+            continue
+        done = period_summaries(sessions, compiled, periods)
+        for period in periods:
+            if output_dir is None:
+                print("== {} {} ==".format(project, period))
+                print_timesheet(done[period])
+            else:
+                name = "{}_{}.txt".format(project.replace(os.sep, "_"), period)
+                with open(os.path.join(output_dir, name), 'w', encoding="utf-8") as out:
+                    print_timesheet(done[period], out)
+
 
 
 
@@ -124,13 +227,29 @@ default_enddate = '19-12-31'
 # Varför göra detta?
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Extract information from timepolice data')
-    parser.add_argument("datastore", help="JSON file with timepolice data")
+    parser.add_argument("datastore", help="JSON, JSON Lines or SQLite file with timepolice data, "
+                        "JSON may be gzip, bzip2 or xz compressed")
     parser.add_argument("--startdate", help="First date to include, yy-mm-dd", default=default_startdate, action='store')
     parser.add_argument("--enddate", help="Last date to include, yy-mm-dd", default=default_enddate, action='store')
     parser.add_argument("--distribution", help="JSON file defining how tasks should be distributed", action='store')
-    parser.add_argument("--report", help="", action='store', default='timesheet')
+    parser.add_argument("--report", help="timesheet, or timesheets for all projects and "
+                        "--periods in one pass", action='store', default='timesheet')
     parser.add_argument("--project", help="Name of project to analyze", action='store', default='Kostnad')
     parser.add_argument("--period", help="Periodicity for sums", action='store', choices=['daily','weekly','monthly'], default='weekly')
+    parser.add_argument("--periods", help="Comma separated periods of --report timesheets",
+                        action='store', default='daily,weekly,monthly')
+    parser.add_argument("--output-dir", help="Directory for the PROJECT_PERIOD.txt files of "
+                        "--report timesheets, default is standard output", action='store')
+    parser.add_argument("--engine", help="dict, or numpy for columnar arrays (requires NumPy)", action='store', choices=['dict','numpy'], default='dict')
+    parser.add_argument("--compact", help="Keep sessions as compact records instead of dicts, "
+                        "uses a fraction of the memory", action='store_true')
+    parser.add_argument("--any-dates", help="Convert every timestamp to a datetime, for stores "
+                        "with other date fields than the TimePolice ones, slower",
+                        action='store_true')
+    parser.add_argument("--cache", help="SQLite file caching timesheet results per period",
+                        action='store')
+    parser.add_argument("--cache-size", help="Size limit of --cache in MiB", type=int,
+                        default=64, action='store')
     args = parser.parse_args()
     datastore = args.datastore
     report = args.report
@@ -139,13 +258,58 @@ if __name__ == '__main__':
     project = args.project
     period = args.period
 
-    storeitems = json.load(open(datastore, 'r', encoding="utf-8"), object_hook=datetime_parser)
+    if args.cache and args.engine != 'dict':
+        parser.error("--cache works with the dict engine")
+    periods = args.periods.split(",")
+    for p in periods:
+        if p not in ('daily', 'weekly', 'monthly'):
+            parser.error("--periods: unknown period {}".format(p))
+    if report == "timesheets" and (args.cache or args.engine != 'dict'):
+        parser.error("--report timesheets works with the dict engine and without --cache")
 
-    if report == "timesheet":
+    object_hook = jsonstore.datetime_parser_any if args.any_dates else jsonstore.datetime_parser
+
+    def load_store():
+        if report in ("timesheet", "timesheets") and \
+                jsonstore.store_format(datastore) == 'sqlite':
+            # Only read the sessions the timesheets cover
+            storeitems = sqlitestore.select_sessions(
+                datastore, project if report == "timesheet" else None,
+                datetime.strptime(startdate, "%y-%m-%d").date().toordinal(),
+                datetime.strptime(enddate, "%y-%m-%d").date().toordinal(),
+                object_hook=object_hook)
+        else:
+            storeitems = jsonstore.iter_records(datastore, object_hook=object_hook)
+        if args.compact:
+            return [records.Session.from_dict(session) for session in storeitems]
+        return list(storeitems)
+
+    if report in ("timesheet", "timesheets"):
         distributionitems = []
         if(args.distribution):
             distribution = args.distribution
             distributionitems = json.load(open(distribution, 'r', encoding="utf-8"),
-                                      object_hook=datetime_parser)
-        timesheet(storeitems, startdate, enddate, distributionitems, project, period)
+                                      object_hook=object_hook)
+        if report == "timesheets":
+            timesheets(build_project_index(load_store()), startdate, enddate, distributionitems,
+                       periods, args.output_dir)
+        elif args.engine == 'numpy':
+            try:
+                import timepolice_columnar
+            except ImportError as ex:
+                parser.error("--engine numpy: {}".format(ex))
+            timepolice_columnar.timesheet(timepolice_columnar.TaskTable.from_store(load_store()),
+                                          startdate, enddate, distributionitems, project, period)
+        elif args.cache:
+            import timepolice_cache
+            cache = timepolice_cache.TimesheetCache(args.cache, args.cache_size*1024*1024)
+            try:
+                timepolice_cache.timesheet(cache, datastore,
+                                           lambda: build_project_index(load_store()), startdate,
+                                           enddate, distributionitems, project, period)
+            finally:
+                cache.close()
+        else:
+            timesheet(build_project_index(load_store()), startdate, enddate, distributionitems,
+                      project, period)
 
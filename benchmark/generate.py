@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""Generate synthetic input data for the ingest scripts.
+
+Usage:
+
+    generate kind rows output [--seed N]
+
+Args:
+    kind
+        movielist   Textfile with one movie on each line
+        filelist    File with list of pathnames
+        tree        Directory tree with one empty file per movie
+        timepolice  Directory with TimePolice CSV sheets and their csv_list,
+                    output/csv_list.json
+    rows    Number of rows (lines, files or sheet rows) to generate
+    output  File or directory to create
+
+Roughly 5% of the rows are comments, wanted movies, subtitles or malformed,
+to exercise the skip and error rules of the parsers.
+"""
+
+import argparse
+import json
+import os
+import random
+from datetime import date, timedelta
+
+WORDS = ["the", "last", "night", "of", "a", "red", "house", "city", "blue", "man", "dark",
+         "river", "star", "war", "love", "story", "dead", "zone", "big", "sleep", "lost", "world",
+         "högt", "över", "havet", "ängel", "sjön", "Åland", "café", "naïve"]
+LOCATIONS = ["A", "B", "C", "D"]
+FORMATS = ["dvd", "xvid", "wmv", "bd", "mkv"]
+CONTAINERS = ["mp4", "avi", "mkv"]
+LANGUAGES = ["en", "se", "dk", "fr", "de", "?"]
+CATEGORIES = ["sf", "drama", "comedy", "zoombie", "thriller", "docu"]
+PROJECTS = ["Privat", "Jobb", "Kostnad", "Shopping"]
+TASKS = ["Person", "Hem", "Dev", "Oaktivitet", "Fysiskt", "Relationer", "Läsa/titta",
+         "Div hemma", "Blockerad", "Musik", "Möte", "Mail"]
+COLUMN_PAIRS = 7
+ROWS_PER_SHEET = 200
+# Sheets cover the weeks from 2015 to 2054 and then start over, so the two
+# digit years of their base dates stay in the 2000s and inside the date range
+# benchmark/run.py queries
+FIRST_WEEK = date(2015, 1, 5)
+WEEKS = 40*52
+
+
+def title(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).capitalize()
+
+
+def movielist_row(rng, i):
+    r = rng.random()
+    if r < 0.01:
+        return "# comment {}\n".format(i)
+    if r < 0.02:
+        return "X{}\t{}\t§wanted\n".format(i, title(rng))
+    if r < 0.03:
+        return "X{}\t{} (1990) (2)\t*dvd\n".format(i, title(rng))
+    attributes = ["*" + rng.choice(FORMATS), "#{}/{}".format(rng.choice(LANGUAGES),
+                                                             rng.choice(LANGUAGES))]
+    attributes += ["§" + c for c in rng.sample(CATEGORIES, rng.randint(0, 2))]
+    if rng.random() < 0.3:
+        attributes.append("&ms")
+    if rng.random() < 0.1:
+        attributes.append("/Comment {}".format(i))
+    rng.shuffle(attributes)
+    name = title(rng)
+    if rng.random() < 0.7:
+        name = "{} ({})".format(name, rng.randint(1930, 2020))
+    return "{}{}\t{}\t{}\n".format(rng.choice(LOCATIONS), i, name, ", ".join(attributes))
+
+
+def movie_path(rng, i):
+    r = rng.random()
+    directory = "movies/{}".format(rng.choice(CATEGORIES))
+    if r < 0.02:
+        return "{}/{} {}.sub".format(directory, title(rng), i)
+    if r < 0.03:
+        return "{}/{}.{}.{}".format(directory, title(rng), i, rng.choice(CONTAINERS))
+    attributes = ""
+    if rng.random() < 0.8:
+        attributes += " ({})".format(rng.randint(1930, 2020))
+    r = rng.random()
+    if r < 0.3:
+        attributes += " ({},swesub)".format(rng.choice(LANGUAGES[:-1]))
+    elif r < 0.5:
+        attributes += " ({})".format(rng.choice(LANGUAGES[:-1]))
+    if rng.random() < 0.1:
+        attributes += " (copy)"
+    return "{}/{} {}{}.{}".format(directory, title(rng), i, attributes, rng.choice(CONTAINERS))
+
+
+def movielist(rows, output, rng):
+    with open(output, 'w', encoding='utf-8') as f:
+        for i in range(rows):
+            f.write(movielist_row(rng, i))
+
+
+def filelist(rows, output, rng):
+    with open(output, 'w', encoding='utf-8') as f:
+        for i in range(rows):
+            f.write(movie_path(rng, i) + "\n")
+
+
+def tree(rows, output, rng):
+    for i in range(rows):
+        path = os.path.join(output, "{:03d}".format(i % 997), movie_path(rng, i))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'w').close()
+
+
+def timepolice_column(rng, day, rows):
+    """Cells (task, time) of one day column of a sheet."""
+    cells = list()
+    seconds = rng.randint(6*3600, 9*3600)
+    while len(cells) < rows:
+        cells.append(("{} {}".format(rng.choice(PROJECTS), day.day), ""))
+        for _ in range(rng.randint(3, 30)):
+            cells.append((rng.choice(TASKS), seconds))
+            seconds += rng.randint(60, 3600)
+        if rng.random() < 0.1:
+            cells.append((rng.choice(TASKS), "..."))
+        else:
+            cells.append(("", seconds))
+        seconds += rng.randint(0, 3600)
+    return cells[:rows]
+
+
+def timepolice(rows, output, rng):
+    os.makedirs(output, exist_ok=True)
+    sheets = list()
+    for (sheet, start) in enumerate(range(0, rows, ROWS_PER_SHEET)):
+        (cycle, week) = divmod(sheet, WEEKS)
+        basedate = FIRST_WEEK + timedelta(days=7*week)
+        name = "{} - {}-Tabell {}.csv".format(basedate.isoformat(),
+                                              (basedate + timedelta(days=6)).isoformat(),
+                                              cycle + 1)
+        sheet_rows = min(ROWS_PER_SHEET, rows - start)
+        columns = [timepolice_column(rng, basedate + timedelta(days=c),
+                                     rng.randint(sheet_rows // 3, sheet_rows))
+                   for c in range(COLUMN_PAIRS)]
+        with open(os.path.join(output, name), 'w', encoding='utf-8', newline='') as f:
+            for r in range(sheet_rows):
+                cells = list()
+                for column in columns:
+                    if r < len(column):
+                        (task, seconds) = column[r]
+                        if isinstance(seconds, int):
+                            seconds = "{:02d}:{:02d}:{:02d}".format(seconds // 3600 % 24,
+                                                                    seconds // 60 % 60,
+                                                                    seconds % 60)
+                        cells += [task, seconds]
+                    else:
+                        cells += ["", ""]
+                f.write(";".join(cells) + ";\r\n")
+        sheets.append({"name": name, "basedate": basedate.strftime("%y-%m-%d"),
+                       "columns": list(range(0, 2*COLUMN_PAIRS, 2))})
+    with open(os.path.join(output, "csv_list.json"), 'w', encoding='utf-8') as f:
+        json.dump(sheets, f, indent=4, ensure_ascii=False)
+
+
+GENERATORS = {"movielist": movielist, "filelist": filelist, "tree": tree,
+              "timepolice": timepolice}
+
+
+def main(kind, rows, output, seed=1):
+    GENERATORS[kind](rows, output, random.Random(seed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate synthetic input data')
+    parser.add_argument("kind", choices=sorted(GENERATORS))
+    parser.add_argument("rows", type=int)
+    parser.add_argument("output")
+    parser.add_argument("--seed", type=int, default=1, action='store')
+    args = parser.parse_args()
+    main(args.kind, args.rows, args.output, args.seed)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""Measure throughput of the ingest, convert and analyze scripts.
+
+Usage:
+
+    run [--rows N ...] [--workdir DIR] [--output FILE] [--compare FILE] [--only NAME ...]
+
+Args:
+    --rows      Input sizes to run, default 1000 10000 100000
+    --workdir   Where generated data and outputs are kept, default a temporary directory
+    --output    JSON file with the results, default benchmark-<timestamp>.json
+    --compare   Earlier results file, print the change in rows/s per case
+    --only      Only run cases whose name starts with one of these
+
+Each case runs its script in a subprocess and records wall time, rows/s and
+the peak resident memory of the subprocess. Data is produced by generate.py
+with a fixed seed, so results of different runs are comparable.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import generate
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+DEFAULT_ROWS = [1000, 10000, 100000]
+
+
+def script(*path):
+    return os.path.normpath(os.path.join(ROOT, *path))
+
+
+def have_numpy():
+    try:
+        import numpy
+    except ImportError:
+        return False
+    return True
+
+
+def cases(data):
+    """The benchmark cases as (name, rows, command), for data produced by prepare()."""
+    d = data
+    rows = d['rows']
+    python = sys.executable
+    ingest_movies = script("ingest", "movies_ingest.py")
+    ingest_timepolice = script("ingest", "timepolice_ingest.py")
+    report_timepolice = script("analyze", "timepolice_report.py")
+    # Covers every session generate.timepolice produces, so rows/s counts d['sessions']
+    timesheet = [d['timepolice.json'], "--project", "Privat", "--startdate", "10-01-01",
+                 "--enddate", "60-12-31"]
+    result = [
+        ("ingest/movies/movielist", rows,
+         [python, ingest_movies, "movielist", d['movielist'], d['out.json']]),
+        ("ingest/movies/movielist-cp1252", rows,
+         [python, ingest_movies, "--encoding", "cp1252-lenient", "movielist",
+          d['movielist.cp1252'], d['out.json']]),
+        ("ingest/movies/movielist-pipeline", rows,
+         [python, ingest_movies, "--pipeline", "movielist", d['movielist'], d['out.json']]),
+        ("ingest/movies/filelist", rows,
+         [python, ingest_movies, "filelist", d['filelist'], d['out.json']]),
+        ("ingest/movies/filelist-jsonl", rows,
+         [python, ingest_movies, "filelist", d['filelist'], d['out.jsonl']]),
+        ("ingest/movies/recursive", d['tree_rows'],
+         [python, ingest_movies, "recursive", d['tree'], d['out.json']]),
+        ("ingest/timepolice", rows,
+         [python, ingest_timepolice, d['csv_list'], d['timepolice'], d['out.json']]),
+        ("ingest/timepolice-mmap", rows,
+         [python, ingest_timepolice, "--reader", "mmap", d['csv_list'], d['timepolice'],
+          d['out.json']]),
+        ("ingest/timepolice-pipeline", rows,
+         [python, ingest_timepolice, "--pipeline", d['csv_list'], d['timepolice'],
+          d['out.json']]),
+        ("ingest/timepolice-jobs{}".format(os.cpu_count()), rows,
+         [python, ingest_timepolice, "--jobs", str(os.cpu_count()), d['csv_list'],
+          d['timepolice'], d['out.json']]),
+        ("convert/movies_toUTF8", rows,
+         [python, script("convert", "movies_toUTF8.py"), d['movielist.cp1252'], d['out.txt']]),
+        ("convert/concat", 2*d['sessions'],
+         [python, script("convert", "concat.py"), d['timepolice.json'], d['timepolice.json'],
+          d['out.json']]),
+        ("convert/concat-gzip", 2*d['sessions'],
+         [python, script("convert", "concat.py"), d['timepolice.json'], d['timepolice.json'],
+          d['out.json.gz']]),
+        ("convert/movies_merge", 2*d['movies'],
+         [python, script("convert", "movies_merge.py"), d['movies.json'], d['movies.json'],
+          d['out.json']]),
+        ("analyze/timepolice_report", d['sessions'],
+         [python, report_timepolice] + timesheet),
+        ("analyze/timepolice_report-sqlite", d['sessions'],
+         [python, report_timepolice, d['timepolice.sqlite']] + timesheet[1:]),
+        ("analyze/timepolice_report-gzip", d['sessions'],
+         [python, report_timepolice, d['timepolice.json.gz']] + timesheet[1:]),
+        ("analyze/movies_report", d['movies'],
+         [python, script("analyze", "movies_report.py"), d['movies.json'], "movielist", "all"]),
+    ]
+    if have_numpy():
+        result.append(("analyze/timepolice_report-numpy", d['sessions'],
+                       [python, report_timepolice, "--engine", "numpy"] + timesheet))
+    return result
+
+
+def prepare(rows, workdir):
+    """Generate the inputs for one size, returns a dict of paths and counts."""
+    base = os.path.join(workdir, str(rows))
+    d = {'rows': rows,
+         'movielist': os.path.join(base, "movielist.txt"),
+         'movielist.cp1252': os.path.join(base, "movielist-cp1252.txt"),
+         'filelist': os.path.join(base, "filelist.txt"),
+         'tree': os.path.join(base, "tree"),
+         'tree_rows': min(rows, 100000),
+         'timepolice': os.path.join(base, "timepolice"),
+         'csv_list': os.path.join(base, "timepolice", "csv_list.json"),
+         'timepolice.json': os.path.join(base, "timepolice-store.json"),
+         'timepolice.sqlite': os.path.join(base, "timepolice-store.sqlite"),
+         'timepolice.json.gz': os.path.join(base, "timepolice-store.json.gz"),
+         'movies.json': os.path.join(base, "movies-store.json"),
+         'out.json': os.path.join(base, "out.json"),
+         'out.jsonl': os.path.join(base, "out.jsonl"),
+         'out.json.gz': os.path.join(base, "out.json.gz"),
+         'out.txt': os.path.join(base, "out.txt")}
+    if not os.path.exists(base):
+        os.makedirs(base)
+        generate.main("movielist", rows, d['movielist'])
+        with open(d['movielist'], 'r', encoding='utf-8') as fin, \
+                open(d['movielist.cp1252'], 'w', encoding='cp1252', errors='replace') as fout:
+            fout.write(fin.read())
+        generate.main("filelist", rows, d['filelist'])
+        # Creating files is slow, the tree is capped at 10^5 files
+        generate.main("tree", d['tree_rows'], d['tree'])
+        generate.main("timepolice", rows, d['timepolice'])
+        subprocess.run([sys.executable, script("ingest", "timepolice_ingest.py"), d['csv_list'],
+                        d['timepolice'], d['timepolice.json']], check=True,
+                       stderr=subprocess.DEVNULL)
+        subprocess.run([sys.executable, script("convert", "concat.py"), d['timepolice.json'],
+                        d['timepolice.sqlite']], check=True)
+        subprocess.run([sys.executable, script("ingest", "movies_ingest.py"), "movielist",
+                        d['movielist'], d['movies.json']], check=True,
+                       stderr=subprocess.DEVNULL)
+    if not os.path.exists(d['timepolice.json.gz']):
+        # Outside the block above so that existing workdirs get it as well
+        subprocess.run([sys.executable, script("convert", "concat.py"), d['timepolice.json'],
+                        d['timepolice.json.gz']], check=True)
+    d['sessions'] = count_records(d['timepolice.json'])
+    d['movies'] = count_records(d['movies.json'])
+    return d
+
+
+def count_records(path):
+    sys.path.insert(0, ROOT)
+    from common import jsonstore
+    return sum(1 for _ in jsonstore.iter_records(path))
+
+
+def measure(command):
+    """Run command, returns (seconds, peak RSS in KiB, returncode).
+
+    Linux carries the peak RSS of the forking process over exec, so peaks
+    below the RSS of this script, some tens of MiB, are not measured.
+    """
+    start = time.perf_counter()
+    # A file, not a pipe, so a command logging more than a pipe buffer does not block
+    with open(os.devnull, 'w') as devnull, tempfile.TemporaryFile() as errors:
+        process = subprocess.Popen(command, stdout=devnull, stderr=errors)
+        (_, status, rusage) = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        errors.seek(0)
+        stderr = errors.read().decode('utf-8', 'replace')
+    if process.returncode != 0:
+        sys.stderr.write(stderr)
+    # ru_maxrss is in KiB on Linux, in bytes on macOS
+    peak = rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else rusage.ru_maxrss
+    return (elapsed, peak, process.returncode)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous):
+    old = {(r['name'], r['rows']): r for r in previous['results']}
+    for r in results:
+        before = old.get((r['name'], r['rows']))
+        if before is None or not before['rows_per_second']:
+            continue
+        change = r['rows_per_second'] / before['rows_per_second'] - 1
+        print("{:<40} {:>9} {:>+8.1%} rows/s {:>+8.1%} peak memory".format(
+            r['name'], r['rows'], change, r['peak_rss_kib'] / before['peak_rss_kib'] - 1))
+
+
+def main(sizes, workdir, output, previous=None, only=None):
+    results = list()
+    for rows in sizes:
+        data = prepare(rows, workdir)
+        for (name, n, command) in cases(data):
+            if only and not any(name.startswith(prefix) for prefix in only):
+                continue
+            (elapsed, peak, returncode) = measure(command)
+            result = {'name': name, 'rows': n, 'seconds': round(elapsed, 4),
+                      'rows_per_second': round(n / elapsed, 1) if elapsed > 0 else None,
+                      'peak_rss_kib': peak, 'returncode': returncode}
+            results.append(result)
+            print("{:<40} {:>9} rows {:>9.3f}s {:>12.0f} rows/s {:>9} KiB{}".format(
+                name, n, elapsed, result['rows_per_second'] or 0, peak,
+                "" if returncode == 0 else " FAILED ({})".format(returncode)))
+    report = {'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+              'git_revision': git_revision(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'cpu_count': os.cpu_count(),
+              'results': results}
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4)
+    if previous:
+        with open(previous, 'r', encoding='utf-8') as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure throughput of the scripts')
+    parser.add_argument("--rows", type=int, nargs='+', default=DEFAULT_ROWS, action='store')
+    parser.add_argument("--workdir", action='store')
+    parser.add_argument("--output", action='store',
+                        default=time.strftime("benchmark-%Y%m%d-%H%M%S.json"))
+    parser.add_argument("--compare", action='store')
+    parser.add_argument("--only", nargs='+', action='store')
+    args = parser.parse_args()
+    if args.workdir:
+        main(args.rows, args.workdir, args.output, args.compare, args.only)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            main(args.rows, workdir, args.output, args.compare, args.only)
@@ -0,0 +1 @@
+"""Helpers shared by the convert, ingest and analyze scripts."""
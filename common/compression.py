@@ -0,0 +1,385 @@
+"""Read and write gzip, bzip2 and xz compressed stores.
+
+Compressed files are written as independently compressed blocks of
+BLOCK_SIZE bytes, compressed on several threads: zlib, bz2 and lzma release
+the GIL while they work. Each block is a complete gzip member or bzip2 or
+xz stream, so the files are read by the gzip, bzip2 and xz tools as usual,
+which decompress the concatenated blocks as one file. gzip blocks carry
+their compressed size in a 'BL' extra field, like BGZF, so a reader can
+find the next block without decompressing the one before it, and xz blocks
+are found from the index at the end of each stream. Files with such blocks
+are decompressed on several threads as well, other files, e.g. from the
+command line tools, and bzip2 files are decompressed as one stream.
+
+Usage:
+
+    compression.add_arguments(parser)
+    args = parser.parse_args()
+    compression.setup(args.compress_workers)
+
+    with compression.open_read("store.json.gz") as f:
+        data = f.read()
+
+    f = compression.writer(open("store.json.gz", 'wb'), 'gzip')
+    f.write(data)
+    f.close()
+"""
+
+import bz2
+import gzip
+import io
+import lzma
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from common import pipeline
+
+BLOCK_SIZE = 1024*1024
+# Larger xz streams are decompressed as one stream, to bound memory use
+MAX_BLOCK_SIZE = 16*1024*1024
+BUFFER_SIZE = 64*1024
+WORKERS = 4
+
+GZIP_LEVEL = 6
+BZ2_LEVEL = 9
+XZ_PRESET = 6
+
+SUFFIXES = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz'}
+MAGIC = ((b'\x1f\x8b', 'gzip'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'xz'))
+
+# gzip member header with FEXTRA holding one 'BL' subfield, the size of the member
+GZIP_HEADER = struct.Struct("<4sIBBH2sHI")
+GZIP_MAGIC = b'\x1f\x8b\x08\x04'
+GZIP_TRAILER = struct.Struct("<II")
+XZ_FOOTER_SIZE = 12
+
+# Default of writer, set by setup
+compress_workers = None
+
+
+def add_arguments(parser):
+    parser.add_argument("--compress-workers", help="Threads compressing independent blocks "
+                        "of a .gz, .bz2 or .xz output, 0 compresses it as one stream",
+                        type=int, action='store')
+
+
+def setup(workers=None):
+    """Set the default workers of writer, None for up to WORKERS."""
+    global compress_workers
+    compress_workers = workers
+
+
+def default_workers():
+    return min(WORKERS, os.cpu_count() or 1)
+
+
+def method_from_path(path):
+    """'gzip', 'bz2' or 'xz' from the extension of path, None if it has none of them."""
+    return SUFFIXES.get(os.path.splitext(path)[1])
+
+
+def strip_suffix(path):
+    """path without its compression extension."""
+    (root, ext) = os.path.splitext(path)
+    return root if ext in SUFFIXES else path
+
+
+def peek_method(f):
+    """Compression of an open binary file from its magic bytes, None if it is not compressed."""
+    head = f.peek(8)
+    for (magic, method) in MAGIC:
+        if head.startswith(magic):
+            return method
+    return None
+
+
+def gzip_block(data):
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    size = GZIP_HEADER.size + len(deflated) + GZIP_TRAILER.size
+    # mtime 0, no extra flags, unknown OS
+    return GZIP_HEADER.pack(GZIP_MAGIC, 0, 0, 255, 8, b'BL', 4, size) + deflated + \
+        GZIP_TRAILER.pack(zlib.crc32(data), len(data) & 0xffffffff)
+
+
+def bz2_block(data):
+    return bz2.compress(data, BZ2_LEVEL)
+
+
+def xz_block(data):
+    # The default 8 MiB dictionary of the preset is wasted memory for one block
+    return lzma.compress(data, filters=[{'id': lzma.FILTER_LZMA2, 'preset': XZ_PRESET,
+                                         'dict_size': max(len(data), 4096)}])
+
+
+COMPRESS_BLOCK = {'gzip': gzip_block, 'bz2': bz2_block, 'xz': xz_block}
+
+COMPRESSOR = {
+    'gzip': lambda: zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+    'bz2': lambda: bz2.BZ2Compressor(BZ2_LEVEL),
+    'xz': lambda: lzma.LZMACompressor(preset=XZ_PRESET),
+}
+
+
+class BlockWriter:
+    """Binary file compressing what is written to it in independent blocks.
+
+    Blocks are compressed on workers threads and written to f in order, at
+    most two blocks per worker are pending. Closing the writer closes f.
+    """
+
+    def __init__(self, f, method, workers=None, block_size=BLOCK_SIZE):
+        self.f = f
+        self.compress = COMPRESS_BLOCK[method]
+        self.workers = workers or default_workers()
+        self.block_size = block_size
+        self.pool = ThreadPoolExecutor(self.workers)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.blocks = 0
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.block_size:
+            self.submit()
+        return len(data)
+
+    def submit(self):
+        self.pending.append(self.pool.submit(self.compress, self.buffer))
+        self.buffer = bytearray()
+        self.blocks += 1
+        while len(self.pending) > 2*self.workers:
+            self.f.write(self.pending.popleft().result())
+
+    def close(self):
+        try:
+            # An empty file is still one valid, empty block
+            if self.buffer or self.blocks == 0:
+                self.submit()
+            while self.pending:
+                self.f.write(self.pending.popleft().result())
+        finally:
+            self.pool.shutdown(cancel_futures=True)
+            self.f.close()
+
+
+class StreamWriter:
+    """Binary file compressing what is written to it as one stream, on one thread."""
+
+    def __init__(self, f, method):
+        self.f = f
+        self.compressor = COMPRESSOR[method]()
+
+    def write(self, data):
+        self.f.write(self.compressor.compress(data))
+        return len(data)
+
+    def close(self):
+        try:
+            self.f.write(self.compressor.flush())
+        finally:
+            self.f.close()
+
+
+def writer(f, method, workers=None):
+    """Wrap binary file f to compress what is written to it.
+
+    Args:
+        f:          File to write the compressed data to, closed with the writer
+        method:     'gzip', 'bz2' or 'xz'
+        workers:    Threads compressing independent blocks, default from setup
+                    or up to WORKERS, 0 compresses all data as one stream
+                    instead, which compresses slightly better but can only be
+                    decompressed on one thread
+    """
+    if workers is None:
+        workers = compress_workers
+    if workers == 0:
+        return StreamWriter(f, method)
+    return BlockWriter(f, method, workers)
+
+
+def gzip_blocks(f):
+    """Yield the members of a gzip file that carry their size.
+
+    Stops at the end of the file or before the first member without a size,
+    leaving f at its start.
+    """
+    while True:
+        start = f.tell()
+        header = f.read(GZIP_HEADER.size)
+        if len(header) < GZIP_HEADER.size:
+            f.seek(start)
+            return
+        (magic, _, _, _, xlen, subfield, length, size) = GZIP_HEADER.unpack(header)
+        if magic != GZIP_MAGIC or xlen != 8 or subfield != b'BL' or length != 4:
+            f.seek(start)
+            return
+        yield header + f.read(size - GZIP_HEADER.size)
+
+
+def read_varint(data, pos):
+    """Decode an xz variable length integer, returns value and next position."""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return (value, pos)
+        shift += 7
+
+
+def xz_streams(f):
+    """(offset, size) of each stream of an xz file from their indexes.
+
+    Returns None if the file cannot be split, e.g. when it is truncated or
+    a stream is larger than MAX_BLOCK_SIZE uncompressed.
+    """
+    streams = list()
+    end = f.seek(0, io.SEEK_END)
+    while end > 0:
+        f.seek(end - 4)
+        if f.read(4) == b'\0\0\0\0':
+            # Stream padding
+            end -= 4
+            continue
+        if end < 2*XZ_FOOTER_SIZE:
+            return None
+        f.seek(end - XZ_FOOTER_SIZE)
+        footer = f.read(XZ_FOOTER_SIZE)
+        if footer[10:] != b'YZ':
+            return None
+        index_size = (int.from_bytes(footer[4:8], 'little') + 1)*4
+        index_start = end - XZ_FOOTER_SIZE - index_size
+        if index_start < XZ_FOOTER_SIZE:
+            return None
+        f.seek(index_start)
+        index = f.read(index_size)
+        try:
+            if index[0] != 0:
+                return None
+            (records, pos) = read_varint(index, 1)
+            blocks_size = 0
+            uncompressed = 0
+            for _ in range(records):
+                (unpadded, pos) = read_varint(index, pos)
+                (size, pos) = read_varint(index, pos)
+                blocks_size += (unpadded + 3) & ~3
+                uncompressed += size
+        except IndexError:
+            return None
+        start = index_start - blocks_size - XZ_FOOTER_SIZE
+        if start < 0 or uncompressed > MAX_BLOCK_SIZE:
+            return None
+        f.seek(start)
+        if f.read(6) != b'\xfd7zXZ\x00':
+            return None
+        streams.append((start, end - start))
+        end = start
+    streams.reverse()
+    return streams
+
+
+def xz_blocks(f):
+    """Yield the streams of an xz file, or nothing if it cannot be split, leaving f at 0."""
+    streams = xz_streams(f)
+    f.seek(0)
+    if streams is None:
+        return
+    for (offset, size) in streams:
+        f.seek(offset)
+        yield f.read(size)
+    # Past the stream padding
+    f.seek(0, io.SEEK_END)
+
+
+BLOCKS = {'gzip': gzip_blocks, 'xz': xz_blocks}
+
+DECOMPRESS_BLOCK = {
+    'gzip': lambda data: zlib.decompress(data, 16 + zlib.MAX_WBITS),
+    'xz': lambda data: lzma.decompress(data, lzma.FORMAT_XZ),
+}
+
+STREAM = {
+    'gzip': lambda f: gzip.GzipFile(fileobj=f, mode='rb'),
+    'bz2': lambda f: bz2.BZ2File(f),
+    'xz': lambda f: lzma.LZMAFile(f),
+}
+
+
+class Decompressor(io.RawIOBase):
+    """Decompressed content of an open compressed file, closing it closes f."""
+
+    def __init__(self, f, method, workers=None):
+        self.f = f
+        self.chunks = self.decompress(method, workers or default_workers())
+        self.chunk = memoryview(b"")
+
+    def decompress(self, method, workers):
+        if workers > 1 and method in BLOCKS:
+            pool = ThreadPoolExecutor(workers)
+            try:
+                yield from pipeline.ordered_map(DECOMPRESS_BLOCK[method], BLOCKS[method](self.f),
+                                                pool, 2*workers)
+            finally:
+                pool.shutdown(cancel_futures=True)
+            if not self.f.peek(1):
+                return
+        # The rest of the file, if it is not in blocks
+        stream = STREAM[method](self.f)
+        try:
+            while True:
+                data = stream.read(BUFFER_SIZE)
+                if not data:
+                    return
+                yield data
+        finally:
+            stream.close()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.chunk:
+            data = next(self.chunks, None)
+            if data is None:
+                return 0
+            self.chunk = memoryview(data)
+        n = min(len(b), len(self.chunk))
+        b[:n] = self.chunk[:n]
+        self.chunk = self.chunk[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.chunks.close()
+            self.f.close()
+        super().close()
+
+
+def open_read(path, workers=None):
+    """Open a file for reading binary, decompressing it if it is compressed.
+
+    Compression is detected from the content, not the name. Returns a
+    buffered binary file, with peek().
+
+    Args:
+        path:       File to read
+        workers:    Threads decompressing independent blocks, default up to
+                    WORKERS, 1 decompresses on the reading thread
+    """
+    f = open(path, 'rb', buffering=BUFFER_SIZE)
+    method = peek_method(f)
+    if method is None:
+        return f
+    return io.BufferedReader(Decompressor(f, method, workers), BUFFER_SIZE)
+
+
+def is_decompressing(f):
+    """True if f was opened by open_read on a compressed file."""
+    return isinstance(getattr(f, 'raw', None), Decompressor)
@@ -0,0 +1,105 @@
+"""Logging setup and run statistics shared by the scripts.
+
+Scripts are quiet by default, only warnings and errors are logged, and
+rows that are rejected are summed up in one warning. With -v the
+statistics of the run are logged when it ends, with -vv every row is
+traced as well.
+
+Usage:
+
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.setup_logging(args.verbose)
+
+    stats = instrument.Stats()
+    for row in stats.timed(rows, "parse"):
+        stats.count("rows read")
+    stats.log_errors(log)
+    stats.log(log)
+"""
+
+import logging
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+LOG_FORMAT = "%(levelname)s %(name)s: %(message)s"
+
+
+def add_arguments(parser):
+    parser.add_argument("-v", "--verbose", help="-v logs a summary of the run, -vv traces "
+                        "every row", action='count', default=0)
+
+
+def setup_logging(verbosity=0):
+    if verbosity >= 2:
+        level = logging.DEBUG
+    elif verbosity == 1:
+        level = logging.INFO
+    else:
+        level = logging.WARNING
+    logging.basicConfig(level=level, format=LOG_FORMAT, stream=sys.stderr)
+
+
+class Stats:
+    """Counters and elapsed time per stage for one run.
+
+    Counter names are grouped on the text before ':', e.g. "rows skipped: empty".
+    """
+
+    def __init__(self):
+        self.counters = Counter()
+        self.elapsed = Counter()
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.elapsed[name] += time.perf_counter() - start
+
+    def timed(self, iterable, name):
+        """Pass the items of iterable through, adding the time spent producing them to name."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.elapsed[name] += time.perf_counter() - start
+                return
+            self.elapsed[name] += time.perf_counter() - start
+            yield item
+
+    def merge(self, other):
+        """Add the counts and times of another Stats, e.g. from a worker process."""
+        self.counters.update(other.counters)
+        self.elapsed.update(other.elapsed)
+
+    def lines(self):
+        lines = list()
+        for name in sorted(self.counters):
+            lines.append("{:<48} {:>12}".format(name, self.counters[name]))
+        for name in sorted(self.elapsed):
+            lines.append("{:<48} {:>11.3f}s".format("time: " + name, self.elapsed[name]))
+        return lines
+
+    def log(self, logger):
+        for line in self.lines():
+            logger.info(line)
+
+    def log_errors(self, logger, group="parse errors"):
+        """Log one warning with the counters of group, e.g. rows rejected, if there are any.
+
+        The rows themselves are only logged with -vv.
+        """
+        counts = sorted((name.partition(":")[2].strip(), n) for (name, n) in self.counters.items()
+                        if name.startswith(group + ":"))
+        if counts:
+            logger.warning("%d %s (%s), -vv logs each of them", sum(n for (_, n) in counts),
+                           group, ", ".join("{} {}".format(name, n) for (name, n) in counts))
@@ -0,0 +1,338 @@
+"""Read and write JSON stores.
+
+A store is a sequence of records, either as one JSON array (the original,
+indent=4 layout), as JSON Lines with one record per line or as an SQLite
+database with indexes for the reports, see sqlitestore. Writers stream
+records to disk as they are produced, readers detect the layout themselves.
+JSON and JSON Lines stores ending with .gz, .bz2 or .xz are compressed, see
+compression, readers detect compressed stores from their content.
+
+Usage:
+
+    with jsonstore.open_writer("store.jsonl.gz") as writer:
+        for record in records:
+            writer.write(record)
+
+    records = jsonstore.load("store.jsonl", object_hook=jsonstore.datetime_parser)
+"""
+
+import io
+import json
+import os
+from datetime import datetime
+
+from common import compression, sqlitestore
+
+FORMATS = ('json', 'jsonl', 'sqlite')
+BUFFER_SIZE = 64*1024
+
+# Fields holding '%Y-%m-%dT%H:%M:%S' timestamps in timepolice stores and distributions
+DATE_FIELDS = frozenset(('date_created', 'date_ingested', 'date_modified', 'start', 'stop',
+                         'start_date'))
+
+
+def parse_datetime(value):
+    """Convert a '%Y-%m-%dT%H:%M:%S' string to datetime, other values are returned as is."""
+    if type(value) is str and len(value) == 19 and value[10] == 'T':
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            pass
+    return value
+
+
+def datetime_parser(json_dict):
+    """object_hook converting the fields in DATE_FIELDS to datetime."""
+    for key in json_dict:
+        if key in DATE_FIELDS:
+            json_dict[key] = parse_datetime(json_dict[key])
+    return json_dict
+
+
+def datetime_parser_any(json_dict):
+    """object_hook for unknown schemas, tries to convert every value to datetime.
+
+    Slower than datetime_parser, timepolice_report uses it with --any-dates.
+    """
+    for (key, value) in json_dict.items():
+        json_dict[key] = parse_datetime(value)
+    return json_dict
+
+
+def date_handler(obj):
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    elif hasattr(obj, 'to_dict'):
+        # records.Record
+        return obj.to_dict()
+    else:
+        raise TypeError('Object of type %s with value of %s is not JSON serializable'
+                        % (type(obj), repr(obj)))
+
+
+def format_from_path(path):
+    """Guess store format from file name, JSON array unless .jsonl, .ndjson, .sqlite or .db.
+
+    A compression extension after these is ignored, e.g. store.jsonl.gz is JSON Lines.
+    """
+    path = compression.strip_suffix(path)
+    if path.endswith(".jsonl") or path.endswith(".ndjson"):
+        return 'jsonl'
+    if path.endswith(".sqlite") or path.endswith(".db"):
+        return 'sqlite'
+    return 'json'
+
+
+class AtomicFile:
+    """Binary file written under a temporary name, renamed to path on close.
+
+    Readers of path see either the old or the complete new content. wrap,
+    e.g. compression.writer, is applied to the temporary file.
+    """
+
+    def __init__(self, path, wrap=None):
+        self.path = path
+        self.tmp = "{}.tmp{}".format(path, os.getpid())
+        self.f = open(self.tmp, 'wb', buffering=BUFFER_SIZE)
+        if wrap is not None:
+            self.f = wrap(self.f)
+
+    def write(self, data):
+        return self.f.write(data)
+
+    def close(self):
+        self.f.close()
+        os.replace(self.tmp, self.path)
+
+    def discard(self):
+        self.f.close()
+        os.remove(self.tmp)
+
+
+class JSONArrayWriter:
+    """Write records as a JSON array, byte identical to json.dumps(records, indent=4)."""
+
+    def __init__(self, f, sort_keys=False):
+        self.f = f
+        self.sort_keys = sort_keys
+        self.count = 0
+
+    def encode(self, record):
+        """Encode a record for write_encoded, does not touch the file."""
+        return json.dumps(record, sort_keys=self.sort_keys, indent=4, default=date_handler,
+                          ensure_ascii=False).replace("\n", "\n    ").encode('utf8')
+
+    def write_encoded(self, data):
+        if self.count == 0:
+            self.f.write(b"[\n    " + data)
+        else:
+            self.f.write(b",\n    " + data)
+        self.count += 1
+
+    def write(self, record):
+        self.write_encoded(self.encode(record))
+
+    def close(self):
+        if self.count == 0:
+            self.f.write(b"[]")
+        else:
+            self.f.write(b"\n]")
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif isinstance(self.f, AtomicFile):
+            self.f.discard()
+        else:
+            # Leave the array unterminated, not a valid but truncated store
+            self.f.close()
+
+
+class JSONLinesWriter:
+    """Write records as JSON Lines, one compact record per line."""
+
+    def __init__(self, f, sort_keys=False):
+        self.f = f
+        self.sort_keys = sort_keys
+        self.count = 0
+
+    def encode(self, record):
+        """Encode a record for write_encoded, does not touch the file."""
+        return (json.dumps(record, sort_keys=self.sort_keys, separators=(',', ':'),
+                           default=date_handler, ensure_ascii=False) + "\n").encode('utf8')
+
+    def write_encoded(self, data):
+        self.f.write(data)
+        self.count += 1
+
+    def write(self, record):
+        self.write_encoded(self.encode(record))
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif isinstance(self.f, AtomicFile):
+            self.f.discard()
+        else:
+            self.f.close()
+
+
+def open_writer(path, fmt=None, sort_keys=False, atomic=False, compress_workers=None):
+    """Open a store for writing.
+
+    Args:
+        path:       Output file, compressed if it ends with .gz, .bz2 or .xz
+        fmt:        'json', 'jsonl' or 'sqlite', guessed from path when None
+        sort_keys:  Sort keys of each record
+        atomic:     Write to a temporary file that replaces path when the
+                    writer is closed, and is removed if an exception leaves
+                    the with block. Without it such an exception leaves a JSON
+                    array unterminated, JSON Lines with the records written
+                    so far and no SQLite store at all
+        compress_workers:
+                    Threads compressing independent blocks of a compressed
+                    store, 0 compresses it as one stream, see compression.writer
+
+    Returns:
+        A writer with write(record) and close(). write(record) is
+        write_encoded(encode(record)), where encode can run in another
+        thread than the writes, see pipeline.
+    """
+    if fmt is None:
+        fmt = format_from_path(path)
+    method = compression.method_from_path(path)
+    if fmt == 'sqlite':
+        if method is not None:
+            raise ValueError("SQLite stores cannot be compressed: {}".format(path))
+        return sqlitestore.SQLiteWriter(path, sort_keys, atomic, default=date_handler)
+    wrap = None
+    if method is not None:
+        wrap = lambda f: compression.writer(f, method, compress_workers)
+    if atomic:
+        f = AtomicFile(path, wrap)
+    else:
+        f = open(path, 'wb', buffering=BUFFER_SIZE)
+        if wrap is not None:
+            f = wrap(f)
+    if fmt == 'jsonl':
+        return JSONLinesWriter(f, sort_keys)
+    elif fmt == 'json':
+        return JSONArrayWriter(f, sort_keys)
+    else:
+        f.close()
+        raise ValueError("Unknown store format: {}".format(fmt))
+
+
+def write(path, records, fmt=None, sort_keys=False, atomic=False, compress_workers=None):
+    """Write all records to a store, returns number of records written."""
+    with open_writer(path, fmt, sort_keys, atomic, compress_workers) as writer:
+        for record in records:
+            writer.write(record)
+        return writer.count
+
+
+def peek_format(f):
+    """Detect layout of an open binary store from its first non-blank byte."""
+    head = f.peek(BUFFER_SIZE)
+    if sqlitestore.is_sqlite(head):
+        return 'sqlite'
+    head = head.lstrip()
+    if head.startswith(b'\xef\xbb\xbf'):
+        head = head[3:].lstrip()
+    if head.startswith(b'['):
+        return 'json'
+    return 'jsonl'
+
+
+def iter_array(f, object_hook=None):
+    """Incrementally decode a JSON array from a text stream, yielding one element at a time.
+
+    Only the element being decoded and one read block are kept in memory.
+    """
+    decoder = json.JSONDecoder(object_hook=object_hook)
+    buf = ""
+    pos = 0
+    eof = False
+
+    def fill(buf, pos):
+        # Drop consumed text and read at least as much as is still pending
+        block = f.read(max(BUFFER_SIZE, len(buf)-pos))
+        return buf[pos:] + block, 0, block == ""
+
+    def skip_blank(buf, pos, eof):
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buf) or eof:
+                return buf, pos, eof
+            buf, pos, eof = fill(buf, pos)
+
+    buf, pos, eof = skip_blank(buf, pos, eof)
+    if buf[pos:pos+1] != "[":
+        raise ValueError("Not a JSON array")
+    buf, pos, eof = skip_blank(buf, pos+1, eof)
+    if buf[pos:pos+1] == "]":
+        return
+    while True:
+        try:
+            (record, end) = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            buf, pos, eof = fill(buf, pos)
+            continue
+        if end == len(buf) and not eof:
+            # A number or literal may continue in the next block
+            buf, pos, eof = fill(buf, pos)
+            continue
+        yield record
+        buf, pos, eof = skip_blank(buf, end, eof)
+        if buf[pos:pos+1] == "]":
+            return
+        if buf[pos:pos+1] != ",":
+            raise ValueError("Expected , or ] in JSON array at offset {}".format(pos))
+        buf, pos, eof = skip_blank(buf, pos+1, eof)
+
+
+def iter_records(path, object_hook=None):
+    """Yield the records of a store, of any format, without loading all of it.
+
+    Compressed stores are decompressed while they are read.
+    """
+    with compression.open_read(path) as f:
+        fmt = peek_format(f)
+        if fmt == 'sqlite':
+            if compression.is_decompressing(f):
+                raise ValueError("SQLite stores cannot be compressed: {}".format(path))
+            f.close()
+            yield from sqlitestore.iter_records(path, object_hook)
+        elif fmt == 'json':
+            text = io.TextIOWrapper(f, encoding='utf-8-sig')
+            for record in iter_array(text, object_hook):
+                yield record
+        else:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line.decode('utf-8-sig'), object_hook=object_hook)
+
+
+def store_format(path):
+    """Layout of the store at path, 'json', 'jsonl' or 'sqlite'."""
+    with compression.open_read(path, workers=1) as f:
+        return peek_format(f)
+
+
+def load(path, object_hook=None):
+    """Load all records of a store into a list."""
+    return list(iter_records(path, object_hook))
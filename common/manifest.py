@@ -0,0 +1,147 @@
+"""Manifest of the inputs a store was ingested from, for incremental ingestion.
+
+The manifest is a JSON file next to the store, by default store + ".manifest".
+It lists the inputs in store order, each with a key identifying the input,
+the parameters it was parsed with, its size, mtime and SHA-256, and the
+number of records it contributed to the store. It also records the size
+and mtime of the store as written, so a manifest is ignored once the store
+has been rewritten or removed by anything else:
+
+    {"version": 2, "store": {"size": 5678, "mtime_ns": ...}, "inputs": [
+        {"key": "...", "params": {...}, "size": 1234, "mtime_ns": ..., "sha256": "...",
+         "records": 12}, ...]}
+
+Runs that rewrite the store without updating the manifest remove it.
+
+Usage:
+
+    entries = manifest.load(manifest.default_path(store), store)
+    previous = {entry['key']: entry for entry in entries}
+    entry = manifest.fingerprint(path, key, params, previous.get(key))
+    if manifest.unchanged(entry, previous.get(key)):
+        ...
+    manifest.save(manifest.default_path(store), new_entries, store)
+"""
+
+import hashlib
+import json
+import os
+
+VERSION = 2
+BLOCK_SIZE = 1024*1024
+
+
+def default_path(store):
+    return store + ".manifest"
+
+
+def store_state(store):
+    """Size and mtime of a store, None if it does not exist."""
+    try:
+        st = os.stat(store)
+    except FileNotFoundError:
+        return None
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def load(path, store):
+    """Load a manifest, returns its entries in store order.
+
+    Empty if there is no manifest, or store is not the store it was saved
+    with, e.g. because another run has rewritten it since.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            content = json.load(f)
+    except FileNotFoundError:
+        return list()
+    if content.get('version') != VERSION:
+        return list()
+    state = store_state(store)
+    if state is None or content.get('store') != state:
+        return list()
+    return content['inputs']
+
+
+def save(path, entries, store):
+    """Atomically write the manifest for entries, a list in store order, after writing store."""
+    tmp = "{}.tmp{}".format(path, os.getpid())
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'version': VERSION, 'store': store_state(store), 'inputs': entries}, f,
+                  indent=4, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def remove(path):
+    """Remove a manifest, when its store is rewritten without it."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fingerprint(path, key, params, previous=None):
+    """Manifest entry for an input file.
+
+    The file is only hashed when size or mtime differ from previous, the
+    entry for the same key in the last manifest.
+    """
+    st = os.stat(path)
+    entry = {'key': key, 'params': params, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    if previous is not None and previous['size'] == st.st_size and \
+            previous['mtime_ns'] == st.st_mtime_ns:
+        entry['sha256'] = previous['sha256']
+    else:
+        entry['sha256'] = sha256_file(path)
+    return entry
+
+
+def fingerprint_names(names, key, params):
+    """Manifest entry for a directory input, from the names of the files in it."""
+    digest = hashlib.sha256()
+    for name in sorted(names):
+        digest.update(name.encode('utf-8', 'surrogateescape') + b'\0')
+    return {'key': key, 'params': params, 'size': len(names), 'mtime_ns': 0,
+            'sha256': digest.hexdigest()}
+
+
+def unchanged(entry, previous):
+    """True if an input was ingested before with the same content and parameters."""
+    return previous is not None and previous['sha256'] == entry['sha256'] and \
+        previous['params'] == entry['params'] and 'records' in previous
+
+
+def split_store(records, previous_entries):
+    """Assign the records of an existing store to the inputs they came from.
+
+    Args:
+        records:            Records of the store, in store order
+        previous_entries:   Manifest entries, in store order
+
+    Returns:
+        A dict from input key to its list of records, or None if the store
+        does not match the manifest or the manifest has duplicate keys.
+    """
+    if len(set(entry['key'] for entry in previous_entries)) != len(previous_entries):
+        return None
+    groups = dict()
+    records = iter(records)
+    for entry in previous_entries:
+        group = list()
+        for _ in range(entry['records']):
+            try:
+                group.append(next(records))
+            except StopIteration:
+                return None
+        groups[entry['key']] = group
+    for _ in records:
+        return None
+    return groups
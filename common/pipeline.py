@@ -0,0 +1,148 @@
+"""Run the stages of an ingest in threads connected by bounded queues.
+
+Reading and decoding the input, parsing rows and encoding records run as
+separate stages, each iterating the stage before it in a thread of its own,
+so a stage waiting on a slow read, e.g. from a network mount, does not
+hold up the others. A stage runs at most maxsize batches ahead of the
+stage consuming it and then blocks until there is room, so memory stays
+bounded when a later stage is slower.
+
+Items come out of a stage in the order the iterable produced them, and an
+exception raised in a stage is raised again in the consumer, so a pipeline
+gives the same result as iterating the stages in one thread.
+
+ordered_map bounds the work handed to an executor in the same way: at
+most a window of items are submitted ahead of the consumer, and their
+results come out in order.
+
+Usage:
+
+    with pipeline.Stage(pipeline.read_lines(path), name="read") as lines, \\
+            pipeline.Stage(parse(lines), name="parse") as items:
+        for item in items:
+            ...
+"""
+
+import queue
+import threading
+from collections import deque
+
+QUEUE_SIZE = 16
+BATCH_SIZE = 256
+PUT_TIMEOUT = 0.1
+
+_END = object()
+
+
+class Failed:
+    """An exception raised in a stage thread, to be raised again by the consumer."""
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class Stage:
+    """Iterate an iterable in a thread and hand out its items through a bounded queue.
+
+    Items are queued in batches of up to batch_size, to keep the locking per
+    item low. close() stops the thread, also when the consumer stops early,
+    and closes the iterable if it has a close method, so closing the last
+    stage of a pipeline closes the stages it reads from.
+    """
+
+    def __init__(self, iterable, maxsize=QUEUE_SIZE, batch_size=BATCH_SIZE, name=None):
+        self.queue = queue.Queue(maxsize)
+        self.batch_size = batch_size
+        self.stopped = threading.Event()
+        self.batch = iter(())
+        self.done = False
+        self.thread = threading.Thread(target=self.run, args=(iterable,), name=name,
+                                       daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        """Queue item, returns False if the stage was closed while waiting for room."""
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(self, iterable):
+        batch = list()
+        try:
+            for item in iterable:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    if not self.put(batch):
+                        return
+                    batch = list()
+            if batch and not self.put(batch):
+                return
+            self.put(_END)
+        except BaseException as ex:
+            if not batch or self.put(batch):
+                self.put(Failed(ex))
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            try:
+                return next(self.batch)
+            except StopIteration:
+                pass
+            if self.done:
+                raise StopIteration
+            batch = self.queue.get()
+            if batch is _END:
+                self.done = True
+            elif isinstance(batch, Failed):
+                self.done = True
+                raise batch.exception
+            else:
+                self.batch = iter(batch)
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def ordered_map(function, items, pool, window):
+    """Yield function(item) for each item, computed by pool, in order.
+
+    At most window items are submitted and not yet yielded, so finished
+    results do not pile up in memory when the consumer falls behind.
+
+    Args:
+        function:   Function to call, picklable for a ProcessPoolExecutor
+        items:      Arguments of function, iterated as results are consumed
+        pool:       concurrent.futures executor computing the results
+        window:     Items in flight, e.g. two per worker
+    """
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(function, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def read_lines(path, encoding="utf-8"):
+    """Yield the lines of a text file, the source of a reading stage."""
+    with open(path, 'r', encoding=encoding) as f:
+        yield from f
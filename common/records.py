@@ -0,0 +1,205 @@
+"""Compact record types for sessions, task entries and movies.
+
+Records keep their fields in __slots__ instead of a dict per record, and
+share equal values: names such as taskname, projectname or audio are
+interned, category lists and the start/stop times within a session are
+stored once. They behave as read-mostly mappings with the JSON keys of the
+store, record['taskname'], record.get('comment') and 'comment' in record,
+so code written for the decoded dicts works on them, and to_dict returns
+the dict they were made from.
+
+Usage:
+
+    sessions = records.load(path, records.Session, object_hook=jsonstore.datetime_parser)
+    jsonstore.write(path, (session.to_dict() for session in sessions))
+"""
+
+import sys
+
+from common import jsonstore
+
+_tuples = dict()
+
+
+def intern_tuple(values):
+    """Return a tuple equal to values, the same object for all equal tuples."""
+    values = tuple(sys.intern(v) if type(v) is str else v for v in values)
+    return _tuples.setdefault(values, values)
+
+
+def intern_text(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+class Record:
+    """Base of the compact records.
+
+    FIELDS maps the JSON keys of a record, in store order, to slot names.
+    """
+
+    __slots__ = ()
+    FIELDS = {}
+
+    def keys(self):
+        return self.FIELDS.keys()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, self.FIELDS[key])
+        except (KeyError, AttributeError):
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.to_dict())
+
+    @classmethod
+    def check_keys(cls, d):
+        for key in d:
+            if key not in cls.FIELDS:
+                raise ValueError("{} has no field {}".format(cls.__name__, key))
+
+
+class TaskEntry(Record):
+    """A task entry of a timepolice session."""
+
+    __slots__ = ('start', 'stop', 'taskname')
+    FIELDS = {'start': 'start', 'stop': 'stop', 'taskname': 'taskname'}
+
+    def __init__(self, start, stop, taskname):
+        self.start = start
+        self.stop = stop
+        self.taskname = taskname
+
+    def __getitem__(self, key):
+        # Keys and slots have the same names
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    @classmethod
+    def from_dict(cls, d, times=None):
+        """Task entry from its dict, times shares equal start and stop values."""
+        cls.check_keys(d)
+        if times is None:
+            times = dict()
+        return cls(times.setdefault(d['start'], d['start']),
+                   times.setdefault(d['stop'], d['stop']), intern_text(d['taskname']))
+
+    def to_dict(self):
+        return {'start': self.start, 'stop': self.stop, 'taskname': self.taskname}
+
+
+class Session(Record):
+    """A timepolice session with its task entries as a tuple of TaskEntry."""
+
+    __slots__ = ('date_created', 'date_ingested', 'date_modified', 'isongoing', 'projectname',
+                 'taskentries')
+    FIELDS = {name: name for name in __slots__}
+
+    def __init__(self, date_created, date_ingested, date_modified, isongoing, projectname,
+                 taskentries):
+        self.date_created = date_created
+        self.date_ingested = date_ingested
+        self.date_modified = date_modified
+        self.isongoing = isongoing
+        self.projectname = projectname
+        self.taskentries = taskentries
+
+    __getitem__ = TaskEntry.__getitem__
+
+    @classmethod
+    def from_dict(cls, d):
+        cls.check_keys(d)
+        # A task usually stops when the next one starts
+        times = dict()
+        date_modified = d['date_modified']
+        if date_modified == d['date_ingested']:
+            date_modified = d['date_ingested']
+        return cls(d['date_created'], d['date_ingested'], date_modified, d['isongoing'],
+                   intern_text(d['projectname']),
+                   tuple(TaskEntry.from_dict(taskentry, times)
+                         for taskentry in d['taskentries']))
+
+    def to_dict(self):
+        return {'date_created': self.date_created, 'date_ingested': self.date_ingested,
+                'date_modified': self.date_modified, 'isongoing': self.isongoing,
+                'projectname': self.projectname,
+                'taskentries': [taskentry.to_dict() for taskentry in self.taskentries]}
+
+
+class Movie(Record):
+    """A movie from a movielist, file list or directory.
+
+    The parsers write different fields, comment or comments, in different
+    orders, so each movie keeps the keys it has as a shared tuple. Fields
+    can be set like in a dict, e.g. to add defaults. Movies merged by
+    movies_merge also have copies, the media of each copy.
+    """
+
+    __slots__ = ('title', 'media_location', 'media_type', 'media_format', 'audio', 'subtitle',
+                 'category', 'comment', 'comments', 'production_year', 'copies', 'fields')
+    FIELDS = {'title': 'title', 'media-location': 'media_location',
+              'media-type': 'media_type', 'media-format': 'media_format', 'audio': 'audio',
+              'subtitle': 'subtitle', 'category': 'category', 'comment': 'comment',
+              'comments': 'comments', 'production-year': 'production_year', 'copies': 'copies'}
+    # Fields with few distinct values
+    INTERNED = frozenset(('media-location', 'media-type', 'media-format', 'audio', 'subtitle'))
+
+    def __init__(self):
+        self.fields = ()
+
+    def keys(self):
+        return self.fields
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        value = getattr(self, self.FIELDS[key])
+        return list(value) if key == 'category' else value
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        if key == 'category':
+            value = intern_tuple(value)
+        elif key in self.INTERNED:
+            value = intern_text(value)
+        setattr(self, self.FIELDS[key], value)
+        if key not in self.fields:
+            self.fields = intern_tuple(self.fields + (key,))
+
+    @classmethod
+    def from_dict(cls, d):
+        cls.check_keys(d)
+        movie = cls()
+        for (key, value) in d.items():
+            if key == 'category':
+                value = intern_tuple(value)
+            elif key in cls.INTERNED:
+                value = intern_text(value)
+            setattr(movie, cls.FIELDS[key], value)
+        movie.fields = intern_tuple(d)
+        return movie
+
+    def to_dict(self):
+        return {key: self[key] for key in self.fields}
+
+
+def load(path, record_type, object_hook=None):
+    """Load all records of a store as record_type, one decoded dict at a time."""
+    return [record_type.from_dict(d) for d in jsonstore.iter_records(path, object_hook)]
@@ -0,0 +1,170 @@
+"""Stores kept in an SQLite database.
+
+Records are stored as compact JSON, one row per record in store order. The
+fields reports select on are also kept in indexed columns, so a report can
+read the sessions of one project and date range without decoding the rest:
+
+    records(id, projectname, date_created, title, body)
+
+projectname and date_created are set for timepolice sessions, title for
+movies, and are NULL for records without the field.
+
+Usage:
+
+    with sqlitestore.SQLiteWriter("store.sqlite") as writer:
+        for record in records:
+            writer.write(record)
+
+    sessions = list(sqlitestore.select_sessions("store.sqlite", "Kostnad", first, last))
+"""
+
+import json
+import os
+import sqlite3
+import urllib.request
+from datetime import date, timedelta
+
+MAGIC = b"SQLite format 3\x00"
+BATCH_SIZE = 1000
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE records (
+    id INTEGER PRIMARY KEY,
+    projectname TEXT,
+    date_created TEXT,
+    title TEXT,
+    body TEXT NOT NULL
+);
+"""
+
+INDEXES = (
+    "CREATE INDEX records_project_date ON records (projectname, date_created) "
+    "WHERE projectname IS NOT NULL",
+    "CREATE INDEX records_title ON records (title) WHERE title IS NOT NULL",
+)
+
+
+def text(value):
+    """Column value of a record field, datetimes as their ISO string."""
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+class SQLiteWriter:
+    """Write records to a new SQLite store, replacing path.
+
+    Rows are inserted in one transaction and the indexes are built when the
+    writer is closed. With atomic the database is built under a temporary
+    name and renamed to path on close, otherwise an existing path is removed
+    first. An exception leaving the with block removes the new database.
+    """
+
+    def __init__(self, path, sort_keys=False, atomic=False, default=None):
+        self.path = path
+        self.sort_keys = sort_keys
+        self.default = default
+        self.count = 0
+        self.tmp = "{}.tmp{}".format(path, os.getpid()) if atomic else None
+        self.target = self.tmp or path
+        for name in (self.target, self.target + "-journal"):
+            if os.path.exists(name):
+                os.remove(name)
+        self.db = sqlite3.connect(self.target, isolation_level=None)
+        # A store is rewritten as a whole, a crash leaves a file to discard anyway
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+        self.db.executescript(SCHEMA)
+        self.db.execute("BEGIN")
+        self.batch = list()
+
+    def encode(self, record):
+        """Column values of a record for write_encoded, does not touch the database."""
+        body = json.dumps(record, sort_keys=self.sort_keys, separators=(',', ':'),
+                          default=self.default, ensure_ascii=False)
+        return (text(record.get('projectname')), text(record.get('date_created')),
+                text(record.get('title')), body)
+
+    def write_encoded(self, columns):
+        self.count += 1
+        self.batch.append((self.count,) + columns)
+        if len(self.batch) >= BATCH_SIZE:
+            self.flush()
+
+    def write(self, record):
+        self.write_encoded(self.encode(record))
+
+    def flush(self):
+        self.db.executemany("INSERT INTO records VALUES (?, ?, ?, ?, ?)", self.batch)
+        self.batch = list()
+
+    def close(self):
+        self.flush()
+        for index in INDEXES:
+            self.db.execute(index)
+        self.db.execute("COMMIT")
+        self.db.close()
+        if self.tmp:
+            os.replace(self.tmp, self.path)
+
+    def discard(self):
+        # Without a journal the transaction cannot be rolled back, remove the file
+        self.db.close()
+        os.remove(self.target)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.discard()
+        else:
+            self.close()
+
+
+def is_sqlite(head):
+    """True if head, the first bytes of a file, is an SQLite database header."""
+    return head.startswith(MAGIC)
+
+
+def connect(path):
+    """Open a store read only."""
+    url = "file:{}?mode=ro".format(urllib.request.pathname2url(os.path.abspath(path)))
+    return sqlite3.connect(url, uri=True)
+
+
+def iter_records(path, object_hook=None):
+    """Yield all records of an SQLite store in store order."""
+    db = connect(path)
+    try:
+        for (body,) in db.execute("SELECT body FROM records ORDER BY id"):
+            yield json.loads(body, object_hook=object_hook)
+    finally:
+        db.close()
+
+
+def select_sessions(path, projectname, startdate, enddate, object_hook=None):
+    """Yield the sessions of a project created from startdate to enddate, both date ordinals.
+
+    Sessions are ordered on date_created, keeping store order for equal
+    values, as timepolice_report.build_project_index orders them. A
+    projectname of None selects the sessions of all projects.
+    """
+    first = date.fromordinal(startdate).isoformat()
+    after = (date.fromordinal(enddate) + timedelta(days=1)).isoformat()
+    db = connect(path)
+    try:
+        if projectname is None:
+            rows = db.execute("SELECT body FROM records WHERE projectname IS NOT NULL AND "
+                              "date_created >= ? AND date_created < ? ORDER BY date_created, id",
+                              (first, after))
+        else:
+            rows = db.execute("SELECT body FROM records WHERE projectname = ? AND "
+                              "date_created >= ? AND date_created < ? ORDER BY date_created, id",
+                              (projectname, first, after))
+        for (body,) in rows:
+            yield json.loads(body, object_hook=object_hook)
+    finally:
+        db.close()
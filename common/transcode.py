@@ -0,0 +1,125 @@
+"""Block based transcoding of legacy encoded text to UTF-8.
+
+Registers the codec 'cp1252-lenient': Windows-1252, with the five bytes
+that Windows-1252 leaves undefined (0x81, 0x8d, 0x8f, 0x90, 0x9d) mapped to
+the Latin-1 control characters instead of raising an error. As a charmap
+codec it decodes through a 256 entry table, and being a registered codec it
+can be used anywhere Python accepts an encoding, e.g. open(path,
+encoding='cp1252-lenient'), which is how the ingest scripts read legacy
+inputs without an intermediate converted file.
+
+Usage:
+
+    transcode.transcode("movielist.txt", "movielist-utf8.txt", "cp1252-lenient")
+"""
+
+import codecs
+import mmap
+
+CHUNK_SIZE = 1024*1024
+LENIENT_CP1252 = 'cp1252-lenient'
+# Stateless single byte codecs that decode ASCII bytes to the same characters,
+# the only ones whose ASCII blocks can be copied to UTF-8 output as they are
+ASCII_SUPERSETS = frozenset((LENIENT_CP1252, 'cp1252', 'iso8859-1', 'iso8859-15', 'ascii'))
+
+
+def _build_decoding_table():
+    table = list()
+    for b in range(256):
+        try:
+            table.append(bytes([b]).decode('cp1252'))
+        except UnicodeDecodeError:
+            table.append(chr(b))
+    return "".join(table)
+
+
+decoding_table = _build_decoding_table()
+encoding_table = codecs.charmap_build(decoding_table)
+
+
+class Codec(codecs.Codec):
+    def encode(self, text, errors='strict'):
+        return codecs.charmap_encode(text, errors, encoding_table)
+
+    def decode(self, data, errors='strict'):
+        return codecs.charmap_decode(data, errors, decoding_table)
+
+
+class IncrementalEncoder(codecs.IncrementalEncoder):
+    def encode(self, text, final=False):
+        return codecs.charmap_encode(text, self.errors, encoding_table)[0]
+
+
+class IncrementalDecoder(codecs.IncrementalDecoder):
+    def decode(self, data, final=False):
+        return codecs.charmap_decode(data, self.errors, decoding_table)[0]
+
+
+class StreamWriter(Codec, codecs.StreamWriter):
+    pass
+
+
+class StreamReader(Codec, codecs.StreamReader):
+    pass
+
+
+def _search(name):
+    if name.replace('-', '_') == LENIENT_CP1252.replace('-', '_'):
+        return codecs.CodecInfo(name=LENIENT_CP1252,
+                                encode=Codec().encode,
+                                decode=Codec().decode,
+                                incrementalencoder=IncrementalEncoder,
+                                incrementaldecoder=IncrementalDecoder,
+                                streamreader=StreamReader,
+                                streamwriter=StreamWriter)
+    return None
+
+
+codecs.register(_search)
+
+
+def iter_blocks(filein, chunk_size=CHUNK_SIZE, use_mmap=False):
+    """Yield the content of a file as blocks of at most chunk_size bytes.
+
+    Args:
+        filein:     Input file
+        chunk_size: Block size in bytes
+        use_mmap:   Memory map the input instead of reading it
+
+    Yields:
+        bytes objects.
+    """
+    with open(filein, 'rb') as f:
+        if use_mmap:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can not be mapped
+                return
+            with mm:
+                for start in range(0, len(mm), chunk_size):
+                    yield mm[start:start+chunk_size]
+        else:
+            for block in iter(lambda: f.read(chunk_size), b''):
+                yield block
+
+
+def transcode(filein, fileout, encoding=LENIENT_CP1252, chunk_size=CHUNK_SIZE, use_mmap=False):
+    """Convert a legacy encoded file to UTF-8, one block at a time.
+
+    Returns:
+        Number of bytes read.
+    """
+    size = 0
+    decoder = codecs.getincrementaldecoder(encoding)()
+    copy_ascii = codecs.lookup(encoding).name in ASCII_SUPERSETS
+    with open(fileout, 'wb') as fout:
+        for block in iter_blocks(filein, chunk_size, use_mmap):
+            size += len(block)
+            if copy_ascii and block.isascii():
+                # ASCII is valid UTF-8 as is
+                fout.write(block)
+            else:
+                fout.write(decoder.decode(block).encode('utf-8'))
+        fout.write(decoder.decode(b'', final=True).encode('utf-8'))
+    return size
@@ -0,0 +1,179 @@
+"""Watch directories for files being added, renamed and deleted.
+
+Both watchers report changes as (event, path) tuples:
+
+    ADD          file path was created or moved in
+    REMOVE       file path was deleted or moved out
+    SCAN         directory path was created or moved in
+    REMOVE_TREE  directory path was deleted or moved out
+    SYNC         the entries of directory path may have changed
+    SYNC_ALL     events were lost, path is None
+
+Inotify uses the Linux inotify API through ctypes. Poller is the fallback
+for other systems and file systems without inotify, e.g. network mounts,
+and reports SYNC for every watched directory whose mtime changed.
+
+Usage:
+
+    watcher = watch.open_watcher()
+    watcher.watch(directory)
+    for (event, path) in watcher.events(timeout=5):
+        ...
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+ADD = 'add'
+REMOVE = 'remove'
+SCAN = 'scan'
+REMOVE_TREE = 'remove_tree'
+SYNC = 'sync'
+SYNC_ALL = 'sync_all'
+
+POLL_INTERVAL = 2.0
+
+# From <sys/inotify.h>
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = os.O_CLOEXEC
+IN_NONBLOCK = os.O_NONBLOCK
+
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR | IN_DONT_FOLLOW
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64*1024
+
+log = logging.getLogger("watch")
+
+
+class Inotify:
+    """Directory watches through inotify, one watch per directory."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not supported")
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.paths = dict()
+        self.descriptors = dict()
+
+    def watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                log.warning("Out of inotify watches for %s, raise "
+                            "/proc/sys/fs/inotify/max_user_watches", path)
+            elif error not in (errno.ENOENT, errno.ENOTDIR):
+                log.warning("Cannot watch %s: %s", path, os.strerror(error))
+            return
+        self.paths[wd] = path
+        self.descriptors[path] = wd
+
+    def unwatch(self, path):
+        wd = self.descriptors.pop(path, None)
+        if wd is not None:
+            self.paths.pop(wd, None)
+            # Fails if the kernel already removed the watch with the directory
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def events(self, timeout=None):
+        """Wait up to timeout seconds, None for ever, and return the changes."""
+        (readable, _, _) = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        changes = list()
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return changes
+            offset = 0
+            while offset < len(data):
+                (wd, mask, _, length) = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset+length].rstrip(b"\0"))
+                offset += length
+                change = self.change(wd, mask, name)
+                if change is not None:
+                    changes.append(change)
+
+    def change(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            return (SYNC_ALL, None)
+        if mask & IN_IGNORED:
+            path = self.paths.pop(wd, None)
+            if self.descriptors.get(path) == wd:
+                del self.descriptors[path]
+            return None
+        if wd not in self.paths:
+            return None
+        path = os.path.join(self.paths[wd], name)
+        if mask & IN_ISDIR:
+            return (SCAN if mask & (IN_CREATE | IN_MOVED_TO) else REMOVE_TREE, path)
+        return (ADD if mask & (IN_CREATE | IN_MOVED_TO) else REMOVE, path)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Poller:
+    """Directory watches by comparing the mtime of each directory.
+
+    Adding, renaming or deleting an entry updates the mtime of the
+    directory it is in, so only changed directories need to be listed.
+    """
+
+    def __init__(self, interval=POLL_INTERVAL):
+        self.interval = interval
+        self.mtimes = dict()
+
+    @staticmethod
+    def mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def watch(self, path):
+        self.mtimes[path] = self.mtime(path)
+
+    def unwatch(self, path):
+        self.mtimes.pop(path, None)
+
+    def events(self, timeout=None):
+        """Sleep until the next poll, at most timeout seconds, and return the changes."""
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        return [(SYNC, path) for (path, mtime) in list(self.mtimes.items())
+                if self.mtime(path) != mtime]
+
+    def close(self):
+        pass
+
+
+def open_watcher(poll_interval=None):
+    """Inotify if available, Poller when it is not or when poll_interval is given."""
+    if poll_interval is None:
+        try:
+            return Inotify()
+        except OSError as ex:
+            log.warning("inotify not available (%s), polling every %s s", ex, POLL_INTERVAL)
+            return Poller()
+    return Poller(poll_interval)
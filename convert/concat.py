@@ -3,46 +3,128 @@
 
 Usage:
 
-    concat input1 input2 output
+    concat [--merge KEY] [--dedup KEY[,KEY...]] [--compress-workers N] input1 input2 ... output
 
 Args:
     input1  First inputfile
     input2  Second inputfile
-    output Outputfile
+    output Outputfile, JSON Lines if it ends with .jsonl or .ndjson, SQLite if it
+           ends with .sqlite or .db, compressed if it ends with .gz, .bz2 or .xz
+    --merge KEY     Merge inputs that are each sorted on KEY, e.g. date_created or title,
+                    into one sorted output instead of appending them
+    --dedup KEYS    Keep only the first record for each combination of the comma
+                    separated KEYS
+    --compress-workers N
+                    Compress output in independent blocks on N threads, default up
+                    to 4, or as one stream with 0
+
+Inputs can be JSON arrays, JSON Lines or SQLite stores, compressed or not, so
+concat also imports JSON into an SQLite store and exports it back, and
+compresses and decompresses stores. Records are streamed
+from input to output, only the records currently being merged are kept in
+memory. The output is written to a temporary file that replaces output
+when all inputs have been read, so output can also be one of the inputs.
 """
 
+import argparse
+import heapq
+import logging
+import os
 import sys
 import json
-from datetime import datetime
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import compression, instrument, jsonstore
+
+log = logging.getLogger("concat")
+
+
+def sort_key(key):
+    """Sort key for records on field key, records without the field sort first."""
+    def get(record):
+        value = record.get(key)
+        return (value is not None, value)
+    return get
+
+
+def check_sorted(records, key, name, inputfile):
+    """Pass records through, raise ValueError if they are not sorted on key."""
+    previous = None
+    for record in records:
+        current = key(record)
+        if previous is not None and current < previous:
+            raise ValueError("{} is not sorted on {}: {} after {}".format(
+                inputfile, name, current[1], previous[1]))
+        previous = current
+        yield record
 
-def datetime_parser(json_dict):
-    for (key, value) in json_dict.items():
-        try:
-            json_dict[key] = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
-        except (ValueError, AttributeError, TypeError):
-            pass
-    return json_dict
 
+def merge(inputfiles, key):
+    """Sorted k-way merge of stores that are each sorted on key."""
+    get = sort_key(key)
+    return heapq.merge(*[check_sorted(jsonstore.iter_records(f), get, key, f)
+                         for f in inputfiles], key=get)
 
-def main(fileargs):
+
+def dedup(records, keys, adjacent=False):
+    """Drop records whose values for keys have been seen before.
+
+    With adjacent=True only the previous record is compared, which is enough
+    when records are sorted on keys and keeps memory use constant.
+    """
+    seen = set()
+    previous = None
+    for record in records:
+        value = json.dumps([record.get(k) for k in keys], sort_keys=True, ensure_ascii=False)
+        if adjacent:
+            if value == previous:
+                continue
+            previous = value
+        else:
+            if value in seen:
+                continue
+            seen.add(value)
+        yield record
+
+
+def main(fileargs, merge_key=None, dedup_keys=None, stats=None):
+    if stats is None:
+        stats = instrument.Stats()
     outputfile = fileargs[len(fileargs)-1]
     inputfiles = fileargs[:len(fileargs)-1]
-    print(outputfile)
-    print(inputfiles)
+    log.info("%s -> %s", inputfiles, outputfile)
 
-    items = list()
-    for f in inputfiles:
-        newitems = json.load(open(f, 'r', encoding="utf-8"), object_hook=datetime_parser)
-        items += newitems
+    if merge_key:
+        items = merge(inputfiles, merge_key)
+    else:
+        items = (item for f in inputfiles for item in jsonstore.iter_records(f))
+    if dedup_keys:
+        items = dedup(items, dedup_keys, adjacent=(dedup_keys == [merge_key]))
 
-    open(outputfile, 'wb').write(json.dumps(items, sort_keys=False, indent=4, ensure_ascii=False)
-                              .encode('utf8'))
+    # Inputs are streamed while the output is written, so the output replaces
+    # outputfile only after all inputs are read, which can include outputfile
+    with jsonstore.open_writer(outputfile, atomic=True) as writer:
+        for item in stats.timed(items, "read"):
+            with stats.stage("write"):
+                writer.write(item)
+        stats.count("records emitted", writer.count)
 
 
 
 if __name__ == '__main__':
-    if len(sys.argv) >= 3:
-        main(sys.argv[1:])
+    parser = argparse.ArgumentParser(description='Concatenate JSON files')
+    parser.add_argument("files", help="Inputfiles followed by outputfile", nargs='+')
+    parser.add_argument("--merge", help="Merge inputs sorted on this key", action='store')
+    parser.add_argument("--dedup", help="Comma separated keys identifying duplicates",
+                        action='store')
+    compression.add_arguments(parser)
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.setup_logging(args.verbose)
+    compression.setup(args.compress_workers)
+    if len(args.files) >= 2:
+        stats = instrument.Stats()
+        main(args.files, args.merge, args.dedup.split(",") if args.dedup else None, stats)
+        stats.log(log)
     else:
         print("{}".format(__doc__))
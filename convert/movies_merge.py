@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+""" Find the same movie in movie stores and merge the duplicates
+
+Usage:
+
+    movies_merge [--report] [--exact] [--max-edits N] [--window N] [--year-tolerance N]
+                 input1 [input2 ...] [output]
+
+Args:
+    input1  Movie store, e.g. from movies_ingest of a movielist
+    input2  More movie stores, e.g. of a filelist and a recursive directory,
+            in order of precedence
+    output  Store of the merged movies, not given with --report
+    --report        Print each group of duplicates instead of writing merged movies
+    --exact         Only merge movies whose normalised titles and years are equal,
+                    --year-tolerance does not apply
+    --max-edits N   Characters that may be inserted, deleted or replaced in the title
+                    of the same movie, at most one per 5 characters, default 2
+    --window N      Titles each title is compared with in sorted order, default 10
+    --year-tolerance N
+                    Years that the years of one movie may differ, default 1
+
+Titles are normalised by ignoring case, accents, punctuation and a leading
+or trailing article. Movies with equal normalised titles and years are found
+with a hash index on (title, year). Titles that differ by a few characters,
+e.g. typos, are found with a sorted neighbourhood: the titles are sorted on
+their text and on their reversed text, and each title is only compared to
+the titles next to it, instead of to all titles. Titles with different
+numbers, e.g. sequels, are never the same title.
+
+Movies with the same or similar titles are the same movie when their years
+differ by at most --year-tolerance, unless there are movies in the years
+around them as well, e.g. remakes every year, then only equal years are the
+same movie. A movie without a year is merged with the movies of the same
+or similar titles if those all are one movie.
+
+A merged movie has the fields of the first movie of its group, in input
+order, with missing fields and unknown years, languages and comments filled
+in from the others, the categories of all of them, and the media-location,
+media-type and media-format of every copy in copies.
+
+Example:
+
+    movies_merge movielist.json filelist.json recursive.json movies.json
+"""
+
+import argparse
+import logging
+import os
+import re
+import sys
+import unicodedata
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import compression, instrument, jsonstore
+
+log = logging.getLogger("movies_merge")
+
+MAX_EDITS = 2
+# Characters of title for each edit, shorter titles must match exactly
+EDIT_LENGTH = 5
+WINDOW = 10
+YEAR_TOLERANCE = 1
+
+ARTICLES = frozenset(("the", "a", "an", "en", "ett"))
+NON_WORD = re.compile(r"[\W_]+")
+NUMBER = re.compile(r"\b(?:\d+|ii|iii|iv|v|vi|vii|viii|ix|x)\b")
+# Values the ingest scripts use for unknown fields
+UNKNOWN = ("", "?", -1, 0, None)
+MEDIA_FIELDS = ("media-location", "media-type", "media-format")
+
+
+def normalise_title(title):
+    """Title to compare, lower case words without accents, punctuation or article."""
+    if not title.isascii():
+        title = "".join(c for c in unicodedata.normalize('NFKD', title)
+                        if not unicodedata.combining(c))
+    words = NON_WORD.sub(" ", title.casefold()).split()
+    if len(words) > 1 and words[0] in ARTICLES:
+        words = words[1:]
+    elif len(words) > 1 and words[-1] in ARTICLES and \
+            title.rpartition(",")[2].strip().casefold() == words[-1]:
+        # Title, The
+        words = words[:-1]
+    return " ".join(words)
+
+
+def title_numbers(title):
+    """Numbers in a normalised title, titles with different numbers are different movies."""
+    return sorted(NUMBER.findall(title))
+
+
+def parse_year(value):
+    """Production year as int, None if unknown, other values, e.g. episodes 1-34, as str."""
+    if value in UNKNOWN:
+        return None
+    if type(value) is int:
+        return value
+    value = str(value).strip()
+    if value.isdigit():
+        return int(value) or None
+    return value or None
+
+
+def edit_distance(title, other, limit):
+    """Levenshtein distance of two titles, limit + 1 for any distance above limit."""
+    # A common prefix and suffix do not change the distance
+    start = 0
+    end = min(len(title), len(other))
+    while start < end and title[start] == other[start]:
+        start += 1
+    (i, j) = (len(title), len(other))
+    while i > start and j > start and title[i-1] == other[j-1]:
+        i -= 1
+        j -= 1
+    (title, other) = (title[start:i], other[start:j])
+    if abs(len(title) - len(other)) > limit:
+        return limit + 1
+    previous = list(range(len(other) + 1))
+    for (x, char) in enumerate(title, 1):
+        current = [x]
+        for (y, other_char) in enumerate(other, 1):
+            current.append(min(previous[y] + 1, current[y-1] + 1,
+                               previous[y-1] + (char != other_char)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return min(previous[-1], limit + 1)
+
+
+def similar_titles(titles, max_edits=MAX_EDITS, window=WINDOW):
+    """Pairs (i, j), j < i, of titles at most max_edits edits apart.
+
+    Titles are found with a sorted neighbourhood: they are sorted on their
+    numbers and text, and on their numbers and reversed text, and each title
+    is only compared to the window - 1 titles after it in either order. A
+    title with a typo ends up next to the correct title in at least one
+    order, unless there are typos at both ends, and the comparisons grow
+    linearly with the titles.
+    """
+    numbers = [title_numbers(title) for title in titles]
+    pairs = set()
+    for key in ([(numbers[i], title) for (i, title) in enumerate(titles)],
+                [(numbers[i], title[::-1]) for (i, title) in enumerate(titles)]):
+        order = sorted(range(len(titles)), key=key.__getitem__)
+        for (position, i) in enumerate(order):
+            title = titles[i]
+            for j in order[position+1:position+window]:
+                other = titles[j]
+                edits = min(max_edits, min(len(title), len(other)) // EDIT_LENGTH)
+                if abs(len(title) - len(other)) <= edits and numbers[i] == numbers[j] and \
+                        edit_distance(title, other, edits) <= edits:
+                    pairs.add((i, j) if j < i else (j, i))
+    return sorted(pairs)
+
+
+class UnionFind:
+    """Disjoint sets of hashable items, each item is a set of its own until joined."""
+
+    def __init__(self):
+        self.parent = dict()
+
+    def find(self, item):
+        path = list()
+        while item in self.parent:
+            path.append(item)
+            item = self.parent[item]
+        for child in path:
+            self.parent[child] = item
+        return item
+
+    def union(self, item, other):
+        root = self.find(item)
+        other_root = self.find(other)
+        if root != other_root:
+            self.parent[other_root] = root
+
+
+def split_movies(keys, year_tolerance=YEAR_TOLERANCE):
+    """Split the (title, year) keys of the same or similar titles into movies.
+
+    Known years are split into runs where each year is at most
+    year_tolerance after the one before it. A run spanning at most
+    year_tolerance years is one movie, the years of a longer run are movies
+    of their own. Keys without a year join the only movie there is.
+
+    Returns:
+        A list of keys for each movie.
+    """
+    by_year = dict()
+    for key in keys:
+        try:
+            by_year[key[1]].append(key)
+        except KeyError:
+            by_year[key[1]] = [key]
+    unknown = by_year.pop(None, [])
+    # Years that are not years, e.g. episodes 1-34, only match themselves
+    movies = [by_year[year] for year in by_year if type(year) is not int]
+    run = list()
+    for year in sorted(year for year in by_year if type(year) is int) + [None]:
+        if run and (year is None or year - run[-1] > year_tolerance):
+            if run[-1] - run[0] <= year_tolerance:
+                movies.append([key for run_year in run for key in by_year[run_year]])
+            else:
+                movies.extend(by_year[run_year] for run_year in run)
+            run = list()
+        if year is not None:
+            run.append(year)
+    if len(movies) == 1:
+        movies[0].extend(unknown)
+    elif not movies:
+        movies.append(unknown)
+    else:
+        movies.extend([key] for key in unknown)
+    return movies
+
+
+def find_duplicates(movies, max_edits=MAX_EDITS, window=WINDOW, year_tolerance=YEAR_TOLERANCE,
+                    fuzzy=True, stats=None):
+    """Group the movies that are the same movie, see the module documentation.
+
+    Args:
+        movies:         Movie records
+        max_edits:      Edits between titles of the same movie
+        window:         Titles each title is compared with in sorted order
+        year_tolerance: Years that the years of one movie may differ
+        fuzzy:          Also merge movies with similar titles and years, not only
+                        equal ones, without it year_tolerance is 0
+        stats:          instrument.Stats timing the stages
+
+    Returns:
+        Lists of positions in movies, one for each movie found more than once,
+        in input order and ordered on their first position.
+
+    Example:
+
+        >>> movies = [{"title": "Alien", "production-year": 1979},
+        ...           {"title": "Alien", "production-year": 1980},
+        ...           {"title": "Alien", "production-year": "1979"}]
+        >>> find_duplicates(movies)
+        [[0, 1, 2]]
+        >>> find_duplicates(movies, fuzzy=False)
+        [[0, 2]]
+    """
+    if stats is None:
+        stats = instrument.Stats()
+    if not fuzzy:
+        year_tolerance = 0
+
+    with stats.stage("exact index"):
+        keys = dict()
+        for (position, movie) in enumerate(movies):
+            title = normalise_title(str(movie.get("title", "")))
+            if not title:
+                # e.g. --- separators of movielists
+                continue
+            key = (title, parse_year(movie.get("production-year")))
+            try:
+                keys[key].append(position)
+            except KeyError:
+                keys[key] = [position]
+        titles = dict()
+        for key in keys:
+            try:
+                titles[key[0]].append(key)
+            except KeyError:
+                titles[key[0]] = [key]
+
+    groups = UnionFind()
+    if fuzzy:
+        with stats.stage("fuzzy index"):
+            title_list = list(titles)
+            for (i, j) in similar_titles(title_list, max_edits, window):
+                groups.union(title_list[i], title_list[j])
+                stats.count("similar titles")
+
+    with stats.stage("group"):
+        similar = dict()
+        for (title, title_keys) in titles.items():
+            try:
+                similar[groups.find(title)].extend(title_keys)
+            except KeyError:
+                similar[groups.find(title)] = list(title_keys)
+        duplicates = list()
+        for similar_keys in similar.values():
+            for movie_keys in split_movies(similar_keys, year_tolerance):
+                positions = [position for key in movie_keys for position in keys[key]]
+                if len(positions) > 1:
+                    duplicates.append(sorted(positions))
+        duplicates.sort()
+    return duplicates
+
+
+def merge_movies(movies):
+    """One movie from the copies of a movie, see the module documentation."""
+    merged = dict(movies[0])
+    categories = list(merged.get("category", []))
+    for movie in movies[1:]:
+        for (key, value) in movie.items():
+            if key == "category":
+                categories.extend(category for category in value if category not in categories)
+            elif key not in MEDIA_FIELDS and key != "copies" and \
+                    (key not in merged or (merged[key] in UNKNOWN and value not in UNKNOWN)):
+                merged[key] = value
+    if categories or "category" in merged:
+        merged["category"] = categories
+    # Movies of a store merged before keep their copies
+    merged["copies"] = list()
+    for movie in movies:
+        merged["copies"].extend(movie.get("copies",
+                                          [{field: movie.get(field) for field in MEDIA_FIELDS}]))
+    return merged
+
+
+def movie_title(movie):
+    """Title of a movie with its year, if it is known."""
+    year = parse_year(movie.get("production-year"))
+    if year is None:
+        return movie.get("title", "")
+    return "{} ({})".format(movie.get("title", ""), year)
+
+
+def print_duplicates(movies, sources, duplicates, out=None):
+    """Print each group of duplicates, the title of its first movie followed by its movies."""
+    for positions in duplicates:
+        print(movie_title(movies[positions[0]]), file=out)
+        for position in positions:
+            movie = movies[position]
+            print("\t{}\t{}\t{}\t{}/{}".format(sources[position], movie.get("media-location"),
+                                               movie_title(movie), movie.get("media-type"),
+                                               movie.get("media-format")), file=out)
+
+
+def main(inputfiles, outputfile=None, max_edits=MAX_EDITS, window=WINDOW,
+         year_tolerance=YEAR_TOLERANCE, fuzzy=True, stats=None):
+    """Merge the movies of inputfiles into outputfile, or print the duplicates if it is None."""
+    if stats is None:
+        stats = instrument.Stats()
+    movies = list()
+    sources = list()
+    with stats.stage("read"):
+        for path in inputfiles:
+            for movie in jsonstore.iter_records(path):
+                movies.append(movie)
+                sources.append(path)
+    stats.count("records read", len(movies))
+
+    duplicates = find_duplicates(movies, max_edits, window, year_tolerance, fuzzy, stats)
+    stats.count("duplicate groups", len(duplicates))
+    stats.count("duplicates merged", sum(len(positions) - 1 for positions in duplicates))
+    if outputfile is None:
+        print_duplicates(movies, sources, duplicates)
+        return
+
+    groups = {positions[0]: positions for positions in duplicates}
+    merged_away = {position for positions in duplicates for position in positions[1:]}
+    with jsonstore.open_writer(outputfile, atomic=True) as writer:
+        for (position, movie) in enumerate(movies):
+            if position in merged_away:
+                continue
+            positions = groups.get(position)
+            with stats.stage("write"):
+                if positions is None:
+                    writer.write(movie)
+                else:
+                    writer.write(merge_movies([movies[other] for other in positions]))
+        stats.count("records emitted", writer.count)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find the same movie in movie stores and '
+                                     'merge the duplicates')
+    parser.add_argument("files", help="Inputfiles followed by outputfile, only inputfiles "
+                        "with --report", nargs='+')
+    parser.add_argument("--report", help="Print the groups of duplicates", action='store_true')
+    parser.add_argument("--exact", help="Only merge equal normalised titles and years",
+                        action='store_true')
+    parser.add_argument("--max-edits", help="Edits between titles of the same movie",
+                        type=int, default=MAX_EDITS, action='store')
+    parser.add_argument("--window", help="Titles each title is compared with in sorted order",
+                        type=int, default=WINDOW, action='store')
+    parser.add_argument("--year-tolerance", help="Years the years of one movie may differ",
+                        type=int, default=YEAR_TOLERANCE, action='store')
+    compression.add_arguments(parser)
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    if args.max_edits < 0 or args.year_tolerance < 0:
+        parser.error("--max-edits and --year-tolerance must not be negative")
+    if args.window < 2:
+        parser.error("--window must be at least 2")
+    if not args.report and len(args.files) < 2:
+        parser.error("give the inputfiles followed by the outputfile, or --report")
+    instrument.setup_logging(args.verbose)
+    compression.setup(args.compress_workers)
+    stats = instrument.Stats()
+    if args.report:
+        main(args.files, None, args.max_edits, args.window, args.year_tolerance, not args.exact,
+             stats)
+    else:
+        main(args.files[:-1], args.files[-1], args.max_edits, args.window,
+             args.year_tolerance, not args.exact, stats)
+    stats.log(log)
@@ -1,36 +1,38 @@
+#!/usr/bin/env python3
+"""Convert a legacy encoded movie list to UTF-8.
+
+Usage:
+
+    movies_toUTF8 [--encoding ENCODING] [--mmap] filein fileout
+
+Args:
+    filein      Latin-1/Windows-1252 encoded input
+    fileout     UTF-8 encoded output
+    --encoding  Input encoding, default cp1252-lenient (Windows-1252 accepting all bytes)
+    --mmap      Memory map the input instead of reading it
+"""
+
+import argparse
+import os
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import transcode
 
-def character(c):
-    if ord(c) == 197:
-        return "Å"
-    if ord(c) == 196:
-        return "Ä"
-    if ord(c) == 214:
-        return "Ö"
-    if ord(c) == 229:
-        return "å"
-    if ord(c) == 228:
-        return "ä"
-    if ord(c) == 246:
-        return "ö"
-    if ord(c) == 167:
-        return "§"
-    if ord(c) > 127:
-        return c
-    return chr(ord(c))
-
-
-def main(filein, fileout):
-    fout = open(fileout, mode="w")
-    with open(filein, mode="rb") as fin:
-        for char in iter(lambda: fin.read(1), ''):
-            if len(char) == 1:
-                fout.write(character(char))
-            else:
-                break
 
+def main(filein, fileout, encoding=transcode.LENIENT_CP1252, use_mmap=False,
+         chunk_size=transcode.CHUNK_SIZE):
+    transcode.transcode(filein, fileout, encoding, chunk_size, use_mmap)
 
 
 if __name__ == "__main__":
-    main(sys.argv[1], sys.argv[2])
+    parser = argparse.ArgumentParser(description='Convert a legacy encoded movie list to UTF-8')
+    parser.add_argument("filein", help="Latin-1/Windows-1252 encoded input")
+    parser.add_argument("fileout", help="UTF-8 encoded output")
+    parser.add_argument("--encoding", help="Input encoding", default=transcode.LENIENT_CP1252,
+                        action='store')
+    parser.add_argument("--mmap", help="Memory map the input", action='store_true')
+    parser.add_argument("--chunk-size", help="Block size in bytes", type=int,
+                        default=transcode.CHUNK_SIZE, action='store')
+    args = parser.parse_args()
+    main(args.filein, args.fileout, args.encoding, args.mmap, args.chunk_size)
@@ -3,7 +3,11 @@
 
 Usage:
 
-    python3 movielist_ingest.py inputtype inputfile outputfile
+    python3 movielist_ingest.py [--format json|jsonl|sqlite] [--encoding ENCODING]
+                                [--incremental] [--workers N] [--pipeline]
+                                [--compress-workers N] [-v]
+                                [--watch [--checkpoint SECONDS] [--poll SECONDS]]
+                                inputtype inputfile outputfile
 
 Args:
     inputtype:  
@@ -13,15 +17,73 @@ Args:
         recursive   Directory, will traverse into subdirectories
     inoutfile:  Source data
     outputfile: JSON result
+    --format:   Output layout, JSON array, JSON Lines or SQLite, default from outputfile
+                extension. JSON outputs ending with .gz, .bz2 or .xz are compressed.
+    --encoding: Encoding of movielist and filelist inputs, default utf-8,
+                cp1252-lenient for legacy lists
+    --workers:  Number of threads scanning directories, default 8
+    --pipeline: Read the input, parse it and encode the movies in separate threads
+                connected by bounded queues, so reads from slow storage overlap
+                with parsing and writing
+    --compress-workers N:
+                Compress a .gz, .bz2 or .xz outputfile in independent blocks on N
+                threads, default up to 4, or as one stream with 0
+    -v:         Log a summary of rows read, skipped and rejected, -vv traces every row
+    --incremental:
+                Leave outputfile as it is if the input, format and outputfile have not
+                changed since the last incremental run, tracked in outputfile.manifest
+    --watch:    Keep running and update outputfile when files are added, renamed or
+                deleted in a directory or recursive input, until interrupted
+    --checkpoint SECONDS:
+                With --watch, write outputfile at most every SECONDS, default 5
+    --poll SECONDS:
+                With --watch, look for changes every SECONDS instead of using inotify
 """
 
+import argparse
+import logging
+import signal
 import sys
-import json
+import time
 import unicodedata
 import os
+from concurrent.futures import ThreadPoolExecutor
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import (compression, instrument, jsonstore, manifest, pipeline, records, transcode,
+                    watch)
 
-def fetch_items_movielist(filein):
+SCAN_WORKERS = 8
+CHECKPOINT_INTERVAL = 5.0
+
+log = logging.getLogger("movies_ingest")
+
+
+class RowError(ValueError):
+    """A row that is not converted to a movie item.
+
+    kind names the rule that rejected the row, skip is True for rows that are
+    left out on purpose, e.g. subtitle files, rather than malformed.
+    """
+
+    def __init__(self, kind, row, skip=False):
+        super().__init__("{}: {}: {}".format("SKIP" if skip else "ERROR", kind, row.rstrip("\n")))
+        self.kind = kind
+        self.skip = skip
+
+
+def count_error(stats, ex):
+    """Count and log a row rejected by get_movie_from_row."""
+    if isinstance(ex, RowError) and ex.skip:
+        stats.count("rows skipped: {}".format(ex.kind))
+        log.debug("%s", ex)
+    else:
+        stats.count("parse errors: {}".format(ex.kind if isinstance(ex, RowError)
+                                               else type(ex).__name__))
+        log.debug("%s", ex)
+
+
+def fetch_items_movielist(filein, encoding="utf-8", stats=None):
     """Fetch movie items from a specially formatted text file.
 
     file = [ comment | movie ]*
@@ -34,96 +96,110 @@ def fetch_items_movielist(filein):
     on_mediaserver = & ms
 
     Args:
-        filein: Input file
+        filein:     Input file
+        encoding:   Encoding of input file
+        stats:      instrument.Stats counting rows
 
-    Returns:
-        A sequence of movie structures.
+    Yields:
+        Movie structures, in file order.
     """
-
-    movies = list()
-    with open(filein, 'r', encoding='utf-8') as f:
-        for row in f:
-            # comment
-            if row[0] == "#":
-                print("continue 1")
-                continue
-
-            # wanted
-            if row.find("§wanted") > -1:
-                print("continue 2")
-                continue
-
-            print(">" + row.strip("\n)"))
-
-            # media_location, title, attributes
-            tokens = row.split("\t")
-            media_location = ""
-            media_type = "disc"
-            title = ""
-            attributes = ""
-            production_year = -1
-            if len(tokens) >= 1:
-                media_location = tokens[0].strip("\n")
-            if len(tokens) >= 2:
-                title = tokens[1].strip("\n")
-                title_parts = title.split("(")
-                if len(title_parts) == 2:
-                    title = title_parts[0].strip()
-                    production_year = title_parts[1].split(")")[0]
-                    if production_year.find("/") >= 0:
-                        print("Error: Illegal production year in {}".format(row))
-                        continue
-                elif len(title_parts) > 2:
-                    print("Error: Too many title parts in {}".format(row))
+    with open(filein, 'r', encoding=encoding) as f:
+        yield from parse_movielist(f, stats)
+
+
+def parse_movielist(rows, stats=None):
+    """Parse the rows of a movielist, see fetch_items_movielist."""
+    if stats is None:
+        stats = instrument.Stats()
+
+    debug = log.isEnabledFor(logging.DEBUG)
+    for row in rows:
+        stats.count("rows read")
+        # comment
+        if row[0] == "#":
+            stats.count("rows skipped: comment")
+            continue
+
+        # wanted
+        if "§wanted" in row:
+            stats.count("rows skipped: wanted")
+            continue
+
+        if debug:
+            log.debug(">%s", row.strip("\n)"))
+
+        # media_location, title, attributes
+        if row[-1] == "\n":
+            row = row[:-1]
+        tokens = row.split("\t", 3)
+        media_location = tokens[0]
+        media_type = "disc"
+        title = ""
+        attributes = ""
+        production_year = -1
+        if len(tokens) >= 2:
+            title = tokens[1]
+            paren = title.find("(")
+            if paren >= 0:
+                if title.find("(", paren + 1) >= 0:
+                    stats.count("parse errors: too many title parts")
+                    log.debug("Error: Too many title parts in %s", row)
                     continue
-            if len(tokens) >= 3:
-                attributes = tokens[2].strip("\n")
-            print("media_location=[{}], title=[{}], production_year={}, attributes=[{}]".format(
-                media_location, title, production_year, attributes))
-
-            # attributes
-            attr = attributes.split(",")
-            media = ""
-            if len(attributes) == 0 and title != "---":
-                media = "AttributeError"
-            if len(attributes) > 0 and attributes[0] == " ":
-                media = "AttributeError"
-            language_spoken = ""
-            language_subtitle = ""
-            category = []
-            onmediaserver = False
-            comment = ""
-            for i in attr:
-                # print("<<{}>>".format(i))
-                i = i.strip(" \n")
-                if len(i) == 0:
+                production_year = title[paren + 1:].partition(")")[0]
+                title = title[:paren].strip()
+                if "/" in production_year:
+                    stats.count("parse errors: illegal production year")
+                    log.debug("Error: Illegal production year in %s", row)
                     continue
-                if i.find("*") == 0:
-                    media = i.strip("*")
-                if i.find("#") == 0:
-                    languages = i.strip("#").split("/")
-                    language_spoken = languages[0]
-                    if len(languages) >= 2:
-                        language_subtitle = languages[1]
-                if i.find("§") == 0:
-                    category.append(i.strip("§"))
-                if i.find("&ms") == 0:
-                    onmediaserver = True
-                if i.find("/") == 0:
-                    comment = i.strip("/")
-
-            print("\tmedia=[{}], spoken=[{}], subtitle=[{}], cat={}, ms=[{}], comment=[{}]".format(
-                media, language_spoken, language_subtitle, category, onmediaserver, comment))
-
-            movie = {"title": title, "media-location": media_location,
-                     "media-type": media_type, "media-format": media,
-                     "audio": language_spoken, "subtitle": language_subtitle,
-                     "category": category, "comment": comment,
-                     "production-year": production_year}
-
-
-            movies.append(movie)
-    return movies
+        if len(tokens) >= 3:
+            attributes = tokens[2]
+        if debug:
+            log.debug("media_location=[%s], title=[%s], production_year=%s, attributes=[%s]",
+                      media_location, title, production_year, attributes)
+
+        # attributes, dispatched on their first character
+        media = ""
+        if len(attributes) == 0 and title != "---":
+            media = "AttributeError"
+        if len(attributes) > 0 and attributes[0] == " ":
+            media = "AttributeError"
+        language_spoken = ""
+        language_subtitle = ""
+        category = []
+        onmediaserver = False
+        comment = ""
+        for i in attributes.split(","):
+            i = i.strip(" ")
+            if len(i) == 0:
+                continue
+            prefix = i[0]
+            if prefix == "*":
+                media = i.strip("*")
+            elif prefix == "#":
+                (language_spoken, slash, languages) = i.strip("#").partition("/")
+                if slash:
+                    language_subtitle = languages.partition("/")[0]
+            elif prefix == "§":
+                category.append(i.strip("§"))
+            elif prefix == "/":
+                comment = i.strip("/")
+            elif prefix == "&" and i.startswith("&ms"):
+                onmediaserver = True
+
+        if debug:
+            log.debug("\tmedia=[%s], spoken=[%s], subtitle=[%s], cat=%s, ms=[%s], "
+                      "comment=[%s]", media, language_spoken, language_subtitle, category,
+                      onmediaserver, comment)
+
+        movie = {"title": title, "media-location": media_location,
+                 "media-type": media_type, "media-format": media,
+                 "audio": language_spoken, "subtitle": language_subtitle,
+                 "category": category, "comment": comment,
+                 "production-year": production_year}
+
+        stats.count("records emitted")
+        yield movie
+
 
 def get_movie_from_row(row):
     """Convert a line of text to a movie item
@@ -145,28 +221,27 @@ def get_movie_from_row(row):
         A movie item.
     """
 
-    print("\n>" + row.strip("\n)"))
-    row = unicodedata.normalize('NFC', row)
-    print("\n>" + row.strip("\n)"))
+    # Names that are plain ASCII are already in NFC
+    if not row.isascii():
+        row = unicodedata.normalize('NFC', row)
+    debug = log.isEnabledFor(logging.DEBUG)
+    if debug:
+        log.debug(">%s", row.strip("\n)"))
 
     # Strip off pathname component(s)
-    filecomponents = row.strip("\n").split("/")
-    filename = filecomponents[len(filecomponents) - 1]
-    print("filename={}".format(filename))
+    path = row.strip("\n")
+    filename = path[path.rfind("/") + 1:]
 
     # Skip files with inbedded "."
-    filecomps = filename.split(".")
-    if len(filecomps) != 2:
-        raise ValueError("ERROR: filename not a file.extension: {}".format(row))
+    if filename.count(".") != 1:
+        raise RowError("filename not a file.extension", row)
 
     # Skip subtitles
-    basename = filecomps[0]
-    filetype = filecomps[1]
+    (basename, _, filetype) = filename.partition(".")
     if filetype == "sub" or filetype == "idx":
-        raise ValueError("SKIP subtitle: {}".format(row))
+        raise RowError("subtitle", row, skip=True)
 
     # Default values
-    title = ""
     media_location = "ms"
     copy = False
     productionyear = 0
@@ -175,64 +250,55 @@ def get_movie_from_row(row):
     category = []
     comments = ""
 
-    print("basename={}".format(basename))
-
-    # Split at "(":
-    attr = basename.split("(")
-
-    # Extract moviename
-    if attr[0] == "":
-        raise ValueError("ERROR: No movietitle: {}".format(row))
-
-    title = attr[0].strip(" ")
-    # Convert to UTF-8
-    # ...
-
-    attr = attr[1:]
+    # Extract moviename, up to the first "("
+    paren = basename.find("(")
+    if paren == 0 or len(basename) == 0:
+        raise RowError("No movietitle", row)
+    if paren < 0:
+        title = basename.strip(" ")
+        attr = []
+    else:
+        title = basename[:paren].strip(" ")
+        attr = basename[paren + 1:].split("(")
 
     for i in attr:
-        print("attribute=[{}]".format(i))
         i = i.strip(" ")
-        if i[len(i) - 1] != ")":
-            raise ValueError("ERROR: Data after ): {}".format(row))
+        if i[-1] != ")":
+            raise RowError("Data after )", row)
         i = i.strip(")")
-        lang = i.split(",")
 
         if len(i) == 0:
-            raise ValueError("ERROR: Empty attribute: {}".format(row))
+            raise RowError("Empty attribute", row)
 
     #   If a number => productionyear
         elif i.isdigit():
             if productionyear != 0:
-                raise ValueError("ERROR: duplicate productionyear: {}".format(row))
+                raise RowError("duplicate productionyear", row)
             productionyear = int(i)
 
     #   If "copy" => copy
         elif i == "copy":
             copy = True
 
-    #   Else language:
-    #       Split at ","
-
-        elif len(lang) == 1:
-            #       If one item:
-            #           audio or "swesub"
-            if lang[0] == "swesub":
-                subtitle = "se"
-            else:
-                audio = lang[0]
-
-    #       If two items:
-        elif len(lang) == 2:
-            #               audio, subtitle or "swesub"
-            audio = lang[0]
-            if lang[1] == "swesub":
-                subtitle = "se"
-            else:
-                subtitle = lang[1]
-
-    print("\ttitle={}, filetype={}, media_location={}, copy={}, productionyear={}, audio={}, subtitle={}"
-          .format(title, filetype, media_location, copy, productionyear, audio, subtitle))
+    #   Else language, audio or "swesub", or audio COMMA subtitle or "swesub"
+        else:
+            (first, comma, second) = i.partition(",")
+            if not comma:
+                if first == "swesub":
+                    subtitle = "se"
+                else:
+                    audio = first
+            elif "," not in second:
+                audio = first
+                if second == "swesub":
+                    subtitle = "se"
+                else:
+                    subtitle = second
+
+    if debug:
+        log.debug("\ttitle=%s, filetype=%s, media_location=%s, copy=%s, productionyear=%s, "
+                  "audio=%s, subtitle=%s", title, filetype, media_location, copy, productionyear,
+                  audio, subtitle)
 
     movie = {"title": title, "media-location": media_location,
              "media-type": "file", "media-format": filetype,
@@ -242,104 +308,443 @@ def get_movie_from_row(row):
     return movie
 
 
-def fetch_items_filelist(filelist):
+def fetch_items_filelist(filelist, encoding="utf-8", stats=None):
     """Fetch movie items from a list of filenames.
 
     filelist = movie*
 
     Args:
-        filelist: Input file
+        filelist:   Input file
+        encoding:   Encoding of input file
+        stats:      instrument.Stats counting rows
 
-    Returns:
-        A sequence of movie structures.
+    Yields:
+        Movie structures, in file order.
     """
-    movies = list()
+    with open(filelist, 'r', encoding=encoding) as file:
+        yield from parse_filelist(file, stats)
 
-    with open(filelist, 'r', encoding='utf-8') as file:
-        for row in file:
-            try:
-                movie = get_movie_from_row(row)
-                movies.append(movie)
-            except ValueError as ex:
-                print(ex)
-    return movies
 
+def parse_filelist(rows, stats=None):
+    """Parse the rows of a file list, see fetch_items_filelist."""
+    if stats is None:
+        stats = instrument.Stats()
+    for row in rows:
+        stats.count("rows read")
+        try:
+            movie = get_movie_from_row(row)
+        except ValueError as ex:
+            count_error(stats, ex)
+            continue
+        stats.count("records emitted")
+        yield movie
+
+
+def list_directory(path):
+    """Split the entries of a directory in files and subdirectories.
+
+    Uses the entry types cached by os.scandir, so on most filesystems no
+    extra stat call is needed per entry. Unreadable directories are empty,
+    as in os.walk.
+    """
+    files = list()
+    subdirectories = list()
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    # Like os.walk, don't follow links to directories
+                    if not entry.is_symlink():
+                        subdirectories.append(entry.path)
+                else:
+                    files.append(entry)
+    except OSError:
+        pass
+    return (files, subdirectories)
+
+
+def scan_directory(directory, recursive=False, workers=SCAN_WORKERS):
+    """Lazily yield the file entries of a directory tree.
+
+    Subdirectories are listed ahead in a thread pool while the files found so
+    far are handed out, entries come in the same order as from os.walk.
+
+    Args:
+        directory:  Directory to scan
+        recursive:  Traverse into subdirectories
+        workers:    Number of threads listing directories
 
-def fetch_items_directory(directory):
+    Yields:
+        os.DirEntry objects of everything that is not a directory.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = [pool.submit(list_directory, directory)]
+        while pending:
+            (files, subdirectories) = pending.pop().result()
+            if recursive:
+                pending.extend(pool.submit(list_directory, subdirectory)
+                               for subdirectory in reversed(subdirectories))
+            for entry in files:
+                yield entry
+
+
+def fetch_items_directory(directory, workers=SCAN_WORKERS, stats=None):
     """Fetch movie items from a directory.
 
     directory = path
 
     Args:
         directory: Input directory
+        workers:   Number of threads scanning the directory
+        stats:     instrument.Stats counting files
 
-    Returns:
-        A sequence of movie structures.
+    Yields:
+        Movie structures, in directory order.
     """
-    movies = list()
-    filelist = os.listdir(directory)
+    return parse_entries(scan_directory(directory, False, workers), False, stats)
 
-    for row in filelist:
-        try:
-            file = "{}/{}".format(directory, row)
-            print("file={}".format(file))
-            if os.path.isfile(file):
-                movie = get_movie_from_row(row)
-                movies.append(movie)
-        except ValueError as ex:
-            print(ex)
-
-    return movies
 
-
-def fetch_items_directory_recursive(directory):
+def fetch_items_directory_recursive(directory, workers=SCAN_WORKERS, stats=None):
     """Fetch movie items from a directory.
 
     directory = path
 
     Args:
         directory: Input directory
+        workers:   Number of threads scanning the directory tree
+        stats:     instrument.Stats counting files
 
-    Returns:
-        A sequence of movie structures.
+    Yields:
+        Movie structures, in walk order.
     """
-    movies = list()
-    filelist = [os.path.join(dp, f)
-                for dp, dn, fn in os.walk(os.path.expanduser(directory)) for f in fn]
+    return parse_entries(scan_directory(os.path.expanduser(directory), True, workers), True,
+                         stats)
 
-    for row in filelist:
+
+def parse_entries(entries, recursive=False, stats=None):
+    """Parse the file entries from scan_directory.
+
+    The movie item of a file in a directory input is parsed from its name,
+    non-files are skipped. In a recursive input it is parsed from the path.
+    """
+    if stats is None:
+        stats = instrument.Stats()
+    for entry in entries:
+        stats.count("rows read")
         try:
-            movie = get_movie_from_row(row)
-            movies.append(movie)
+            if recursive:
+                movie = get_movie_from_row(entry.path)
+            else:
+                if not entry.is_file():
+                    stats.count("rows skipped: not a file")
+                    continue
+                movie = get_movie_from_row(entry.name)
+        except ValueError as ex:
+            count_error(stats, ex)
+            continue
+        stats.count("records emitted")
+        yield movie
+
+
+class Catalog:
+    """Movie items of a directory tree, kept up to date from watch events.
+
+    Movies are kept as records.Movie by path, in the order the files were
+    found, rejected files as None. Only the directories being watched are
+    listed, and only added files are parsed.
+    """
+
+    def __init__(self, watcher, recursive=False, stats=None):
+        self.watcher = watcher
+        self.recursive = recursive
+        self.stats = stats if stats is not None else instrument.Stats()
+        self.movies = dict()
+        self.files = dict()
+        self.dirty = False
+
+    def add(self, path):
+        directory = os.path.dirname(path)
+        if directory not in self.files:
+            return
+        self.stats.count("rows read")
+        self.files[directory].add(path)
+        self.dirty = True
+        try:
+            # Like fetch_items_directory, the name alone for a single directory
+            movie = get_movie_from_row(path if self.recursive else os.path.basename(path))
         except ValueError as ex:
-            print(ex)
+            count_error(self.stats, ex)
+            self.movies[path] = None
+            return
+        self.movies[path] = records.Movie.from_dict(movie)
+        log.info("added %s", path)
+
+    def remove(self, path):
+        files = self.files.get(os.path.dirname(path))
+        if files is not None and path in files:
+            files.discard(path)
+            if self.movies.pop(path, None) is not None:
+                log.info("removed %s", path)
+            self.dirty = True
+
+    def scan(self, directory):
+        """Watch directory, and its subdirectories when recursive, and add their files."""
+        pending = [directory]
+        while pending:
+            path = pending.pop()
+            if path in self.files:
+                self.sync(path)
+                continue
+            self.watcher.watch(path)
+            self.files[path] = set()
+            (entries, subdirectories) = list_directory(path)
+            for entry in entries:
+                if self.recursive or entry.is_file():
+                    self.add(entry.path)
+            if self.recursive:
+                pending.extend(reversed(subdirectories))
+
+    def remove_tree(self, directory):
+        prefix = os.path.join(directory, "")
+        for path in [path for path in self.files if path == directory or path.startswith(prefix)]:
+            for file in list(self.files[path]):
+                self.remove(file)
+            del self.files[path]
+            self.watcher.unwatch(path)
+
+    def sync(self, directory):
+        """List a watched directory again and apply the differences."""
+        if directory not in self.files:
+            return
+        self.watcher.watch(directory)
+        (entries, subdirectories) = list_directory(directory)
+        present = {entry.path for entry in entries if self.recursive or entry.is_file()}
+        for path in self.files[directory] - present:
+            self.remove(path)
+        for entry in entries:
+            if entry.path in present and entry.path not in self.files[directory]:
+                self.add(entry.path)
+        if self.recursive:
+            known = [path for path in self.files if os.path.dirname(path) == directory and
+                     path != directory]
+            for path in set(known) - set(subdirectories):
+                self.remove_tree(path)
+            for path in subdirectories:
+                if path not in self.files:
+                    self.scan(path)
+
+    def apply(self, event, path):
+        if event == watch.ADD:
+            if self.recursive or os.path.isfile(path):
+                self.add(path)
+        elif event == watch.REMOVE:
+            self.remove(path)
+        elif event == watch.SCAN:
+            if self.recursive and os.path.dirname(path) in self.files:
+                self.scan(path)
+        elif event == watch.REMOVE_TREE:
+            self.remove_tree(path)
+        elif event == watch.SYNC:
+            self.sync(path)
+        elif event == watch.SYNC_ALL:
+            log.warning("Lost watch events, listing all directories again")
+            for directory in list(self.files):
+                self.sync(directory)
+
+    def items(self):
+        return [movie for movie in self.movies.values() if movie is not None]
+
+
+def watch_directory(filetype, directory, fileout, fmt=None, interval=CHECKPOINT_INTERVAL,
+                    poll_interval=None, stats=None):
+    """Keep fileout up to date with the movie files in directory until interrupted.
+
+    The directory is scanned once, after that only added, renamed and
+    deleted files are applied. The store is rewritten atomically at most
+    every interval seconds while there are changes, and when stopped.
+
+    Args:
+        filetype:       directory or recursive
+        directory:      Directory to watch
+        fileout:        Store to keep up to date
+        fmt:            Store format, default from fileout extension
+        interval:       Seconds between checkpoints
+        poll_interval:  Poll directories every poll_interval seconds instead
+                        of using inotify
+        stats:          instrument.Stats counting files
+    """
+    manifest.remove(manifest.default_path(fileout))
+    watcher = watch.open_watcher(poll_interval)
+    catalog = Catalog(watcher, filetype == "recursive", stats)
+    checkpoint = None
+    try:
+        catalog.scan(os.path.normpath(os.path.expanduser(directory)))
+        # Write the store once the tree is scanned, even if it is empty
+        catalog.dirty = True
+        while True:
+            timeout = None
+            if catalog.dirty:
+                now = time.monotonic()
+                if checkpoint is None or now - checkpoint >= interval:
+                    count = jsonstore.write(fileout, catalog.items(), fmt, atomic=True)
+                    catalog.dirty = False
+                    checkpoint = now
+                    log.info("checkpoint %d movies to %s", count, fileout)
+                    continue
+                timeout = checkpoint + interval - now
+            for (event, path) in watcher.events(timeout):
+                catalog.apply(event, path)
+    finally:
+        if catalog.dirty:
+            count = jsonstore.write(fileout, catalog.items(), fmt, atomic=True)
+            log.info("checkpoint %d movies to %s", count, fileout)
+        watcher.close()
 
-    return movies
 
+def input_fingerprint(filetype, filein, encoding, fmt, previous):
+    """Manifest entry for the input, keyed on its path.
 
-def main(filetype, filein, fileout):
-    """Dispatch the correct parser and write output encoded as JSON document.
+    Lists and file lists are fingerprinted on content, directories on the
+    names of the files in them, since a movie item only depends on the name.
     """
-    items = list()
+    key = os.path.abspath(filein)
+    params = {'inputtype': filetype, 'encoding': encoding, 'format': fmt}
+    if filetype == "directory":
+        return manifest.fingerprint_names([entry.name for entry in scan_directory(filein)],
+                                          key, params)
+    elif filetype == "recursive":
+        return manifest.fingerprint_names([entry.path for entry in
+                                           scan_directory(os.path.expanduser(filein), True)],
+                                          key, params)
+    return manifest.fingerprint(filein, key, params, previous)
+
 
+def pipeline_stages(filetype, filein, encoding, workers, writer, stats):
+    """Reading, parsing and encoding stages of --pipeline.
+
+    Returns:
+        The stages in order, the last one yields the movies encoded by
+        writer.encode.
+    """
+    if filetype in ("movielist", "filelist"):
+        rows = pipeline.Stage(pipeline.read_lines(filein, encoding), name="read")
+    elif filetype == "directory":
+        rows = pipeline.Stage(scan_directory(filein, False, workers), name="read")
+    else:
+        rows = pipeline.Stage(scan_directory(os.path.expanduser(filein), True, workers),
+                              name="read")
     if filetype == "movielist":
-        items = fetch_items_movielist(filein)
+        movies = parse_movielist(rows, stats)
     elif filetype == "filelist":
-        items = fetch_items_filelist(filein)
+        movies = parse_filelist(rows, stats)
+    else:
+        movies = parse_entries(rows, filetype == "recursive", stats)
+    movies = pipeline.Stage(movies, name="parse")
+    encoded = pipeline.Stage((writer.encode(movie) for movie in movies), name="encode")
+    return [rows, movies, encoded]
+
+
+def main(filetype, filein, fileout, fmt=None, encoding="utf-8", incremental=False,
+         workers=SCAN_WORKERS, stats=None, use_pipeline=False):
+    """Dispatch the correct parser and stream output encoded as JSON document.
+    """
+    if stats is None:
+        stats = instrument.Stats()
+    if incremental and filetype in ("movielist", "filelist", "directory", "recursive"):
+        previous_entries = manifest.load(manifest.default_path(fileout), fileout)
+        previous = previous_entries[0] if len(previous_entries) == 1 else None
+        entry = input_fingerprint(filetype, filein, encoding,
+                                  fmt or jsonstore.format_from_path(fileout), previous)
+        if manifest.unchanged(entry, previous) and previous['key'] == entry['key']:
+            log.info("unchanged %s", filein)
+            return
+        entry['records'] = main(filetype, filein, fileout, fmt, encoding, workers=workers,
+                                stats=stats, use_pipeline=use_pipeline)
+        manifest.save(manifest.default_path(fileout), [entry], fileout)
+        return
+    if filetype in ("movielist", "filelist", "directory", "recursive"):
+        # The store no longer matches the manifest of an earlier incremental run
+        manifest.remove(manifest.default_path(fileout))
+
+    if use_pipeline and filetype in ("movielist", "filelist", "directory", "recursive"):
+        # Read, parse and encode in threads, write in this one
+        stage_stats = instrument.Stats()
+        with jsonstore.open_writer(fileout, fmt, atomic=True) as writer:
+            stages = pipeline_stages(filetype, filein, encoding, workers, writer, stage_stats)
+            try:
+                for data in stats.timed(stages[-1], "wait for pipeline"):
+                    with stats.stage("write"):
+                        writer.write_encoded(data)
+            finally:
+                for stage in reversed(stages):
+                    stage.close()
+                stats.merge(stage_stats)
+            return writer.count
+    elif filetype == "movielist":
+        items = fetch_items_movielist(filein, encoding, stats)
+    elif filetype == "filelist":
+        items = fetch_items_filelist(filein, encoding, stats)
     elif filetype == "directory":
-        items = fetch_items_directory(filein)
+        items = fetch_items_directory(filein, workers, stats)
     elif filetype == "recursive":
-        items = fetch_items_directory_recursive(filein)
+        items = fetch_items_directory_recursive(filein, workers, stats)
     else:
         print("{}".format(__doc__))
         return
 
-    open(fileout, 'wb').write(json.dumps(items, sort_keys=False, indent=4, ensure_ascii=False)
-                              .encode('utf8'))
+    with jsonstore.open_writer(fileout, fmt, atomic=True) as writer:
+        for item in stats.timed(items, "parse"):
+            with stats.stage("write"):
+                writer.write(item)
+        return writer.count
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 4:
-        main(sys.argv[1], sys.argv[2], sys.argv[3])
-    else:
-        print("{}".format(__doc__))
+    parser = argparse.ArgumentParser(description='Convert list of movies to JSON document')
+    parser.add_argument("inputtype", help="movielist, filelist, directory or recursive")
+    parser.add_argument("inputfile", help="Source data")
+    parser.add_argument("outputfile", help="JSON result")
+    parser.add_argument("--format", help="Output layout, default from outputfile extension",
+                        choices=jsonstore.FORMATS, action='store')
+    parser.add_argument("--encoding", help="Encoding of movielist and filelist inputs, e.g. {}"
+                        .format(transcode.LENIENT_CP1252), default="utf-8", action='store')
+    parser.add_argument("--incremental", help="Skip the run if the input has not changed, "
+                        "see outputfile.manifest", action='store_true')
+    parser.add_argument("--workers", help="Threads scanning directories", type=int,
+                        default=SCAN_WORKERS, action='store')
+    parser.add_argument("--pipeline", help="Read, parse and encode in separate threads "
+                        "connected by bounded queues", action='store_true')
+    parser.add_argument("--watch", help="Keep outputfile up to date with a directory until "
+                        "interrupted", action='store_true')
+    parser.add_argument("--checkpoint", help="With --watch, seconds between writes of "
+                        "outputfile", type=float, default=CHECKPOINT_INTERVAL, action='store')
+    parser.add_argument("--poll", help="With --watch, poll for changes every POLL seconds "
+                        "instead of using inotify", type=float, action='store')
+    compression.add_arguments(parser)
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.setup_logging(args.verbose)
+    compression.setup(args.compress_workers)
+    stats = instrument.Stats()
+    if args.watch:
+        if args.inputtype not in ("directory", "recursive"):
+            parser.error("--watch needs a directory or recursive input")
+        # Stop on kill as on ^C, writing the last changes
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            watch_directory(args.inputtype, args.inputfile, args.outputfile, args.format,
+                            args.checkpoint, args.poll, stats)
+        except KeyboardInterrupt:
+            pass
+        stats.log_errors(log)
+        stats.log(log)
+        sys.exit(0)
+    with stats.stage("total"):
+        main(args.inputtype, args.inputfile, args.outputfile, args.format, args.encoding,
+             args.incremental, args.workers, stats, args.pipeline)
+    stats.log_errors(log)
+    stats.log(log)
@@ -2,21 +2,53 @@
 """Ingest CSV files generated by TimePolice app.
 
 Usage:
-    timepolice_ingest csv_list basedir json_output
+    timepolice_ingest [--jobs N | --pipeline] [--format json|jsonl|sqlite] [--encoding ENCODING]
+                      [--incremental] [--reader csv|mmap] [--compress-workers N] [-v]
+                      csv_list basedir json_output
+
+Args:
+    --jobs N    Parse sheets in N worker processes, default 1
+    --format    Output layout, JSON array, JSON Lines or SQLite, default from json_output
+                extension. JSON outputs ending with .gz, .bz2 or .xz are compressed.
+    --encoding  Encoding of the sheets, default utf-8, cp1252-lenient for legacy exports
+    --incremental
+                Only parse sheets that changed since the last incremental run and
+                reuse the sessions of the others from json_output. Inputs are
+                tracked in json_output.manifest, which is ignored when json_output
+                has been rewritten since.
+    --pipeline  Read the sheets, parse them and encode the sessions in separate
+                threads connected by bounded queues, so reads from slow storage
+                overlap with parsing and writing
+    --reader    csv, default, or mmap to memory map the sheets and check the skip
+                rules on their bytes, decoding only the cells that are parsed
+    --compress-workers N
+                Compress a .gz, .bz2 or .xz json_output in independent blocks on N
+                threads, default up to 4, or as one stream with 0
+    -v          Log a summary of rows read, skipped and sessions written, -vv traces
+                every row
 """
+import argparse
+import codecs
 import csv
+import logging
+import mmap
+import os
+import re
 import sys
 import json
-from datetime import datetime, date, time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, date, time, timedelta
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import compression, instrument, jsonstore, manifest, pipeline, transcode
 
-def datetime_parser(json_dict):
-    for (key, value) in json_dict.items():
-        try:
-            json_dict[key] = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
-        except (ValueError, AttributeError, TypeError):
-            pass
-    return json_dict
+log = logging.getLogger("timepolice_ingest")
+
+# Encodings where ';', '\r', '\n' and '.' are single bytes that never occur inside a character
+BYTES_ENCODINGS = frozenset(('ascii', 'utf-8', 'iso8859-1', 'iso8859-15', 'cp1252',
+                             transcode.LENIENT_CP1252))
+BYTES_FALLBACK = re.compile(rb'["\0]|\r(?!\n)')
 
 
 def get_date(base_date, a_day):
@@ -33,168 +65,578 @@ def get_date(base_date, a_day):
     return date(year, month, day)
 
 
+DAY = 24*60*60
+# Times in a session are seconds since 0001-01-01T00:00:00 less one day,
+# ordinal*DAY + seconds of the day, so the initial datetime(1, 1, 1) is DAY
+NO_TIME = DAY
+
+_seconds = dict()
+
+
+def parse_seconds(timestamp):
+    """Seconds since midnight of a "%H:%M:%S" timestamp.
+
+    HH:MM:SS is parsed with integer arithmetic, other forms through
+    datetime.strptime, so the same timestamps are accepted and the same
+    ValueError is raised for the others.
+    """
+    try:
+        return _seconds[timestamp]
+    except KeyError:
+        pass
+    if len(timestamp) == 8 and timestamp[2] == ":" and timestamp[5] == ":" and \
+            timestamp.isascii() and timestamp[0:2].isdigit() and timestamp[3:5].isdigit() and \
+            timestamp[6:8].isdigit():
+        (hours, minutes, seconds) = (int(timestamp[0:2]), int(timestamp[3:5]),
+                                     int(timestamp[6:8]))
+        if hours < 24 and minutes < 60 and seconds < 60:
+            # At most one entry per second of the day
+            _seconds[timestamp] = hours*3600 + minutes*60 + seconds
+            return _seconds[timestamp]
+    t = datetime.strptime(timestamp, "%H:%M:%S").time()
+    return t.hour*3600 + t.minute*60 + t.second
+
+
+def to_datetime(seconds):
+    """datetime of a time in the ordinal*DAY + seconds form of SessionParser."""
+    (ordinal, seconds) = divmod(seconds, DAY)
+    return datetime.fromordinal(ordinal) + timedelta(seconds=seconds)
+
+
 def session_time(session_started, session_day_offset, timestamp):
     d = session_started.date().toordinal()
-    t = datetime.strptime(timestamp, "%H:%M:%S").time()
-    st = datetime.combine(date.fromordinal(d+session_day_offset), t)
-    return st
+    return to_datetime((d+session_day_offset)*DAY + parse_seconds(timestamp))
 
 
-def fetch_items(file, input_encoding, input_delimiter, base_date, skipcolumns):
-    sessions = list()
-    taskentries = list()
-    sessionname = str()
-    sessioncreated = str()
-    sessionisongoing = False
-    session_day_offset = 0
-    taskname = str()
-    starttime = datetime(1, 1, 1)
-    stoptime = datetime(1, 1, 1)
-    #with open(file, 'r', encoding='iso-8859-1') as f:
-    with open(file, 'r', encoding=input_encoding) as f:
-        #reader = csv.reader(f, delimiter='\t')
-        reader = csv.reader(f, delimiter=input_delimiter[0])
-        for row in reader:
-            print(row)
-            if len(row) <= skipcolumns:
-                # Not enough columns
-                print("continue 1")
-                continue
-            if len(row) >= skipcolumns+1 and row[0+skipcolumns] == "" and row[1+skipcolumns] == "":
-                # Empty row
-                print("continue 2")
-                continue
-            if len(row) >= skipcolumns+2 and row[skipcolumns+1] == "...":
-                # Unfinished task, skip row, next row will be empty or start of new session
-                print("continue 3")
-                taskname = ""
-                continue
-            if len(row) == 1+skipcolumns or (len(row) >= 2+skipcolumns
-                                             and row[1+skipcolumns] == ""):
-                if sessionname == "":
-                    # Start of new sesseion, no previous session
-                    d = get_date(base_date, int(row[0+skipcolumns].split()[-1]))
-                    sessioncreated = datetime.combine(d, time(0, 0))
-                    if row[0+skipcolumns].startswith("*"):
-                        print("case s1")
-                        sessionisongoing = True
-                        sessionname = " ".join(row[0+skipcolumns].split()[1:-1])
-                    else:
-                        print("case s2")
-                        sessionisongoing = False
-                        sessionname = " ".join(row[0+skipcolumns].split()[0:-1])
-                else:
-                    # Switch session
-                    now = datetime.now()
-                    session = {
-                        'projectname': sessionname,
-                        'isongoing': sessionisongoing,
-                        'date_created': sessioncreated,
-                        'date_ingested': now,
-                        'date_modified': now,
-                        'taskentries': taskentries}
-                    sessions.append(session)
-                    session_day_offset = 0
-                    taskentries = list()
-                    starttime = datetime(1, 1, 1)
-                    stoptime = datetime(1, 1, 1)
-
-                    d = get_date(base_date, int(row[0+skipcolumns].split()[-1]))
-                    sessioncreated = datetime.combine(d, time(0, 0))
-                    if row[0+skipcolumns].startswith("*"):
-                        print("case s3")
-                        sessionisongoing = True
-                        sessionname = " ".join(row[0+skipcolumns].split()[1:-1])
-                    else:
-                        print("case s4")
-                        sessionisongoing = False
-                        sessionname = " ".join(row[0+skipcolumns].split()[0:-1])
-            else:
-                # Not start of session
-                print(len(row))
-                if row[0+skipcolumns] == "":
-                    # Stop and add ongoing task, don't start new
-                    print("case t1")
-                    stoptime = session_time(sessioncreated, session_day_offset, row[1+skipcolumns])
-                    if stoptime < starttime:
-                        print("case t1 - new day")
-                        session_day_offset = session_day_offset+1
-                        stoptime = session_time(sessioncreated, session_day_offset,
-                                                row[1+skipcolumns])
-                    print(starttime, stoptime)
-                    taskentry = {'taskname':taskname, 'start': starttime, 'stop': stoptime}
-                    taskentries.append(taskentry)
-                    taskname = ""
-                else:
-                    if taskname == "":
-                        # No ongoing task, start a new task
-                        print("case t2")
-                        taskname = row[0+skipcolumns]
-                        starttime = session_time(sessioncreated, session_day_offset,
-                                                 row[1+skipcolumns])
-                        if starttime < stoptime:
-                            # Compensate for start of new day
-                            print("case t2 - new day")
-                            session_day_offset = session_day_offset+1
-                            starttime = session_time(sessioncreated, session_day_offset,
-                                                     row[1+skipcolumns])
-                        print(starttime, stoptime)
-                    else:
-                        # Stop and add ongoing task, start new task
-                        print("case t3")
-                        stoptime = session_time(sessioncreated, session_day_offset,
-                                                row[1+skipcolumns])
-                        if stoptime < starttime:
-                            # Compensate for start of new day
-                            print("case t3 - new day")
-                            session_day_offset = session_day_offset+1
-                            stoptime = session_time(sessioncreated, session_day_offset,
-                                                    row[1+skipcolumns])
-                        print(starttime, stoptime)
-                        taskentry = {'taskname':taskname, 'start': starttime, 'stop': stoptime}
-                        taskentries.append(taskentry)
-                        taskname = row[0+skipcolumns]
-                        starttime = stoptime
-    if len(taskentries) > 0:
+class SessionParser:
+    """Session state machine for one column pair of a TimePolice sheet.
+
+    Rows are fed one at a time with feed(), finish() returns the sessions found.
+    Skipped rows and parsed task entries are counted in stats.
+
+    Start and stop times are kept as integers, see parse_seconds, from the
+    day of the session and its day offset, so a new day is detected by
+    comparing integers. datetimes are only made for the task entries.
+
+    When a session header cannot be parsed the rows up to the next header
+    are skipped, instead of adding their tasks to the session before it.
+    """
+
+    def __init__(self, base_date, skipcolumns, stats=None):
+        self.base_date = base_date
+        self.skipcolumns = skipcolumns
+        self.stats = stats if stats is not None else instrument.Stats()
+        self.sessions = list()
+        self.taskentries = list()
+        self.sessionname = str()
+        self.sessioncreated = str()
+        self.session_day = None
+        self.sessionisongoing = False
+        self.session_day_offset = 0
+        # The last session header could not be parsed
+        self.invalid_session = False
+        self.taskname = str()
+        self.starttime = NO_TIME
+        self.stoptime = NO_TIME
+        # The last time converted, the stop of a task is the start of the next
+        self.converted = (NO_TIME, datetime(1, 1, 1))
+        self.debug = log.isEnabledFor(logging.DEBUG)
+
+    def add_session(self):
         now = datetime.now()
         session = {
-            'projectname': sessionname,
-            'isongoing': sessionisongoing,
-            'date_created': sessioncreated,
+            'projectname': self.sessionname,
+            'isongoing': self.sessionisongoing,
+            'date_created': self.sessioncreated,
             'date_ingested': now,
             'date_modified': now,
-            'taskentries': taskentries}
-        sessions.append(session)
+            'taskentries': self.taskentries}
+        self.sessions.append(session)
+
+    def start_session(self, cell):
+        try:
+            d = get_date(self.base_date, int(cell.split()[-1]))
+        except ValueError:
+            # No session until the next header, as if this one was the first
+            self.sessionname = str()
+            self.sessioncreated = str()
+            self.session_day = None
+            self.taskname = str()
+            self.invalid_session = True
+            raise
+        self.invalid_session = False
+        self.sessioncreated = datetime.combine(d, time(0, 0))
+        self.session_day = d.toordinal()*DAY
+        if cell.startswith("*"):
+            self.sessionisongoing = True
+            self.sessionname = " ".join(cell.split()[1:-1])
+        else:
+            self.sessionisongoing = False
+            self.sessionname = " ".join(cell.split()[0:-1])
+
+    def session_time(self, timestamp):
+        if self.session_day is None:
+            # A time before the first session, fails on sessioncreated as before
+            session_time(self.sessioncreated, self.session_day_offset, timestamp)
+        return self.session_day + self.session_day_offset*DAY + parse_seconds(timestamp)
+
+    def to_datetime(self, seconds):
+        if seconds != self.converted[0]:
+            self.converted = (seconds, to_datetime(seconds))
+        return self.converted[1]
+
+    def add_taskentry(self):
+        taskentry = {'taskname': self.taskname, 'start': self.to_datetime(self.starttime),
+                     'stop': self.to_datetime(self.stoptime)}
+        self.taskentries.append(taskentry)
+        self.stats.count("task entries")
 
+    def unfinished(self):
+        # Unfinished task, skip row, next row will be empty or start of new session
+        self.stats.count("cells skipped: unfinished task")
+        log.debug("%d: unfinished task %s", self.skipcolumns, self.taskname)
+        self.taskname = ""
+
+    def feed(self, row):
+        skipcolumns = self.skipcolumns
+        if len(row) <= skipcolumns:
+            # Not enough columns
+            self.stats.count("cells skipped: not enough columns")
+            return
+        if len(row) >= skipcolumns+1 and row[0+skipcolumns] == "" and row[1+skipcolumns] == "":
+            # Empty row
+            self.stats.count("cells skipped: empty")
+            return
+        if len(row) >= skipcolumns+2 and row[skipcolumns+1] == "...":
+            self.unfinished()
+            return
+        self.parse(row[0+skipcolumns], row[1+skipcolumns] if len(row) >= 2+skipcolumns else "")
+
+    def parse(self, cell, timestamp):
+        """Run the state machine on the cells of a row that passed the skip rules of feed.
+
+        cell is the task or session cell of the column pair and timestamp
+        the time cell, "" if the row ends after cell.
+        """
+        skipcolumns = self.skipcolumns
+        if timestamp == "":
+            if self.sessionname == "":
+                # Start of new sesseion, no previous session
+                log.debug("%d: first session %s", skipcolumns, cell)
+            else:
+                # Switch session
+                log.debug("%d: next session %s", skipcolumns, cell)
+                self.add_session()
+                self.session_day_offset = 0
+                self.taskentries = list()
+                self.starttime = NO_TIME
+                self.stoptime = NO_TIME
+            self.start_session(cell)
+        elif self.invalid_session:
+            self.stats.count("cells skipped: invalid session")
+        else:
+            # Not start of session
+            if cell == "":
+                # Stop and add ongoing task, don't start new
+                self.stoptime = self.session_time(timestamp)
+                if self.stoptime < self.starttime:
+                    log.debug("%d: new day", skipcolumns)
+                    self.session_day_offset = self.session_day_offset+1
+                    self.stoptime = self.stoptime+DAY
+                if self.debug:
+                    log.debug("%d: stop %s %s %s", skipcolumns, self.taskname,
+                              self.to_datetime(self.starttime), self.to_datetime(self.stoptime))
+                self.add_taskentry()
+                self.taskname = ""
+            elif self.taskname == "":
+                # No ongoing task, start a new task
+                self.taskname = cell
+                self.starttime = self.session_time(timestamp)
+                if self.starttime < self.stoptime:
+                    # Compensate for start of new day
+                    log.debug("%d: new day", skipcolumns)
+                    self.session_day_offset = self.session_day_offset+1
+                    self.starttime = self.starttime+DAY
+                if self.debug:
+                    log.debug("%d: start %s %s", skipcolumns, self.taskname,
+                              self.to_datetime(self.starttime))
+            else:
+                # Stop and add ongoing task, start new task
+                self.stoptime = self.session_time(timestamp)
+                if self.stoptime < self.starttime:
+                    # Compensate for start of new day
+                    log.debug("%d: new day", skipcolumns)
+                    self.session_day_offset = self.session_day_offset+1
+                    self.stoptime = self.stoptime+DAY
+                if self.debug:
+                    log.debug("%d: switch %s %s %s", skipcolumns, self.taskname,
+                              self.to_datetime(self.starttime), self.to_datetime(self.stoptime))
+                self.add_taskentry()
+                self.taskname = cell
+                self.starttime = self.stoptime
+
+    def finish(self):
+        if len(self.taskentries) > 0:
+            self.add_session()
+        return self.sessions
+
+
+def parse_rows(lines, file, input_delimiter, base_date, columns, stats=None):
+    """Parse all column pairs of a sheet in a single pass over its lines.
+
+    Sessions are returned column by column, in the order given by columns.
+    file only names the sheet in the log.
+    """
+    if stats is None:
+        stats = instrument.Stats()
+    parsers = [SessionParser(base_date, column, stats) for column in columns]
+    reader = csv.reader(lines, delimiter=input_delimiter[0])
+    for row in reader:
+        log.debug("row %s", row)
+        stats.count("rows read")
+        for parser in parsers:
+            try:
+                parser.feed(row)
+            except ValueError as ex:
+                stats.count("parse errors: {}".format(type(ex).__name__))
+                log.debug("%s: column %d: %s in row %s", file, parser.skipcolumns, ex, row)
+
+    sessions = list()
+    for parser in parsers:
+        sessions.extend(parser.finish())
     return sessions
 
 
-def date_handler(obj):
-    if hasattr(obj, 'isoformat'):
-        return obj.isoformat()
-    elif isinstance(obj, ...):
-        return ...
-    else:
-        raise TypeError('Object of type %s with value of %s is not JSON serializable'
-                        % (type(obj), repr(obj)))
+def bytes_scannable(mm, encoding):
+    """True if the sheet can be split into lines and cells on its bytes.
+
+    The encoding must be ASCII compatible with single byte delimiters, and
+    the sheet must not use what only csv.reader handles: quoted cells, NUL
+    characters and lines ending in a lone carriage return.
+    """
+    try:
+        name = codecs.lookup(encoding).name
+    except LookupError:
+        return False
+    return name in BYTES_ENCODINGS and BYTES_FALLBACK.search(mm) is None
+
+
+def parse_mapped(mm, file, input_encoding, input_delimiter, base_date, columns, stats):
+    """parse_rows on a memory mapped sheet, finding lines and cells on the bytes.
 
+    The skip rules of SessionParser.feed are checked on the bytes of each
+    cell, and only the two cells of each column pair that passes are
+    decoded and handed to SessionParser.parse. Cells that are never decoded
+    are not checked for decoding errors.
+    """
+    delimiter = input_delimiter[0].encode(input_encoding)
+    parsers = [SessionParser(base_date, column, stats) for column in columns]
+    # Rows of only delimiters skip the same cells for a given length, they are
+    # counted per length. feed raises IndexError on some lengths, keep those.
+    padding = Counter()
+    raising = frozenset(column+1 for column in columns)
+    rows = 0
+    short = 0
+    empty = 0
+    try:
+        for line in iter(mm.readline, b""):
+            rows += 1
+            # Every carriage return is followed by a newline, see bytes_scannable
+            line = line.rstrip(b"\r\n")
+            if not line.strip(delimiter):
+                length = line.count(delimiter) + 1 if line else 0
+                if length not in raising:
+                    padding[length] += 1
+                    continue
+            # Empty cells are all the same b"" object, padding costs no allocation
+            cells = line.split(delimiter) if line else []
+            length = len(cells)
+            for parser in parsers:
+                skipcolumns = parser.skipcolumns
+                if length <= skipcolumns:
+                    short += 1
+                    continue
+                cell = cells[skipcolumns]
+                if length > skipcolumns+1:
+                    timestamp = cells[skipcolumns+1]
+                    if not cell and not timestamp:
+                        empty += 1
+                        continue
+                    if timestamp == b"...":
+                        parser.unfinished()
+                        continue
+                    timestamp = timestamp.decode(input_encoding)
+                elif not cell:
+                    # feed raises IndexError on this row, as with the csv reader
+                    parser.feed([value.decode(input_encoding) for value in cells])
+                else:
+                    timestamp = ""
+                try:
+                    parser.parse(cell.decode(input_encoding), timestamp)
+                except ValueError as ex:
+                    stats.count("parse errors: {}".format(type(ex).__name__))
+                    log.debug("%s: column %d: %s in row %s", file, skipcolumns, ex,
+                                [value.decode(input_encoding) for value in cells])
+    finally:
+        for (length, n) in padding.items():
+            for column in columns:
+                if length <= column:
+                    short += n
+                else:
+                    empty += n
+        for (name, n) in (("rows read", rows), ("cells skipped: not enough columns", short),
+                          ("cells skipped: empty", empty)):
+            if n:
+                stats.count(name, n)
 
-def main(csv_list, basedirectory, json_store):
-    f = open(json_store, 'wb')
     sessions = list()
-    sheets = json.load(open(csv_list, 'r', encoding="utf-8"), object_hook=datetime_parser)
-    print(sheets)
+    for parser in parsers:
+        sessions.extend(parser.finish())
+    return sessions
+
+
+def fetch_items_columns(file, input_encoding, input_delimiter, base_date, columns, stats=None,
+                        reader='csv'):
+    """Parse all column pairs of a sheet in a single pass over the file.
+
+    With reader 'mmap' the sheet is memory mapped and scanned on its bytes,
+    see parse_mapped, unless only csv.reader can read it or rows are traced.
+    """
+    if stats is None:
+        stats = instrument.Stats()
+    if reader == 'mmap' and not log.isEnabledFor(logging.DEBUG):
+        with open(file, 'rb') as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can not be mapped
+                return []
+            with mm:
+                if bytes_scannable(mm, input_encoding):
+                    return parse_mapped(mm, file, input_encoding, input_delimiter, base_date,
+                                        columns, stats)
+    with open(file, 'r', encoding=input_encoding) as f:
+        return parse_rows(f, file, input_delimiter, base_date, columns, stats)
+
+
+def fetch_items(file, input_encoding, input_delimiter, base_date, skipcolumns, stats=None):
+    return fetch_items_columns(file, input_encoding, input_delimiter, base_date, [skipcolumns],
+                               stats)
+
+
+def sheet_jobs(sheets, basedirectory, jobs, encoding="utf-8", reader='csv'):
+    """Split the sheets of a csv_list into parse jobs, in manifest order.
+
+    When there are fewer sheets than workers the column pairs of each sheet
+    are split into contiguous groups, so concatenating the results of the jobs
+    in order gives the same sessions as a sequential run.
+
+    Returns:
+        A list with the list of jobs for each sheet.
+    """
+    groups = max(1, -(-jobs // max(1, len(sheets))))
+    joblists = list()
     for sheet in sheets:
-        for column in sheet['columns']:
-            items = fetch_items(basedirectory+"/"+sheet['name'], "utf-8", ';',
-                                datetime.strptime(sheet['basedate'], "%y-%m-%d"), column)
-            for session in items:
-                sessions.append(session)
-    f.write(json.dumps(sessions, sort_keys=True, indent=4, default=date_handler,
-                       ensure_ascii=False).encode('utf8'))
-
-
-if len(sys.argv) == 4:
-    main(sys.argv[1], sys.argv[2], sys.argv[3])
-else:
-    print("{}".format(__doc__))
+        columns = sheet['columns']
+        size = max(1, -(-len(columns) // groups))
+        joblists.append([(basedirectory+"/"+sheet['name'], sheet['basedate'], columns[i:i+size],
+                          encoding, reader)
+                         for i in range(0, len(columns), size)])
+    return joblists
+
+
+def parse_sheet(job):
+    """Run one job from sheet_jobs, returns its sessions and the Stats of the job."""
+    (file, basedate, columns, encoding, reader) = job
+    stats = instrument.Stats()
+    with stats.stage("parse sheets"):
+        sessions = fetch_items_columns(file, encoding, ';',
+                                       datetime.strptime(basedate, "%y-%m-%d"), columns, stats,
+                                       reader)
+    return (sessions, stats)
+
+
+def read_sheets(joblist):
+    """Yield the lines of the sheet of each job from sheet_jobs, and a None after each sheet.
+
+    The reading stage of --pipeline.
+    """
+    for (file, _, _, encoding, _) in joblist:
+        yield from pipeline.read_lines(file, encoding)
+        yield None
+
+
+def parse_sheets(joblist, lines):
+    """Parse the lines from read_sheets, yields the results of parse_sheet for each job.
+
+    The parsing stage of --pipeline.
+    """
+    lines = iter(lines)
+
+    def sheet_lines():
+        for line in lines:
+            if line is None:
+                return
+            yield line
+
+    for (file, basedate, columns, _, _) in joblist:
+        stats = instrument.Stats()
+        with stats.stage("parse sheets"):
+            sessions = parse_rows(sheet_lines(), file, ';', datetime.strptime(basedate, "%y-%m-%d"),
+                                  columns, stats)
+        yield (sessions, stats)
+
+
+def sheet_sessions(sheets, reuse, groups, joblists, results, stats):
+    """Yield (i, sessions) for each sheet, in csv_list order.
+
+    The sessions of unchanged sheets are taken from groups, those of the
+    other sheets from results, the (sessions, stats) of each job in joblists.
+    """
+    parsed = iter(joblists)
+    for (i, sheet) in enumerate(sheets):
+        if reuse[i]:
+            log.info("unchanged %s", sheet['name'])
+            stats.count("sheets unchanged")
+            yield (i, groups[sheet_key(sheet)])
+        else:
+            stats.count("sheets parsed")
+            sessions = list()
+            for _ in next(parsed):
+                (job_sessions, job_stats) = next(results)
+                stats.merge(job_stats)
+                sessions.extend(job_sessions)
+            yield (i, sessions)
+
+
+def encode_sheets(sheets, writer):
+    """Encode the sessions from sheet_sessions for writer.write_encoded.
+
+    The encoding stage of --pipeline.
+    """
+    for (i, sessions) in sheets:
+        yield (i, [writer.encode(session) for session in sessions])
+
+
+def sheet_key(sheet):
+    """Identifies a sheet in the manifest, name and column set."""
+    return "{} {}".format(sheet['name'], json.dumps(sheet['columns']))
+
+
+def reusable_sheets(sheets, basedirectory, json_store, encoding):
+    """Find the sheets whose sessions can be taken from the existing store.
+
+    Returns:
+        (entries, reuse, groups), the new manifest entries, a flag per sheet
+        telling if it is unchanged, and the existing sessions per sheet key.
+    """
+    previous_entries = manifest.load(manifest.default_path(json_store), json_store)
+    previous = {entry['key']: entry for entry in previous_entries}
+    entries = list()
+    for sheet in sheets:
+        key = sheet_key(sheet)
+        entries.append(manifest.fingerprint(basedirectory+"/"+sheet['name'], key,
+                                            {'basedate': sheet['basedate'], 'encoding': encoding},
+                                            previous.get(key)))
+    reuse = [manifest.unchanged(entry, previous.get(entry['key'])) for entry in entries]
+    groups = None
+    if any(reuse) and len(set(entry['key'] for entry in entries)) == len(entries):
+        groups = manifest.split_store(jsonstore.iter_records(json_store), previous_entries)
+    if groups is None:
+        reuse = [False for _ in sheets]
+    return (entries, reuse, groups)
+
+
+def main(csv_list, basedirectory, json_store, jobs=1, fmt=None, encoding="utf-8",
+         incremental=False, stats=None, use_pipeline=False, reader='csv'):
+    if stats is None:
+        stats = instrument.Stats()
+    sheets = json.load(open(csv_list, 'r', encoding="utf-8"))
+    log.debug("sheets %s", sheets)
+    if incremental:
+        (entries, reuse, groups) = reusable_sheets(sheets, basedirectory, json_store, encoding)
+    else:
+        reuse = [False for _ in sheets]
+        groups = None
+        # The store no longer matches the manifest of an earlier incremental run
+        manifest.remove(manifest.default_path(json_store))
+    joblists = sheet_jobs([sheet for (sheet, r) in zip(sheets, reuse) if not r], basedirectory,
+                          jobs, encoding, reader)
+    joblist = [job for jobs_of_sheet in joblists for job in jobs_of_sheet]
+
+    pool = None
+    stages = list()
+    # Stats of the pipeline threads, merged when they are done
+    stage_stats = instrument.Stats()
+    try:
+        with jsonstore.open_writer(json_store, fmt, sort_keys=True, atomic=True) as writer:
+            if use_pipeline:
+                # Read, parse and encode in threads, write in this one
+                lines = pipeline.Stage(read_sheets(joblist), name="read")
+                stages.append(lines)
+                results = pipeline.Stage(parse_sheets(joblist, lines), maxsize=2, batch_size=1,
+                                         name="parse")
+                stages.append(results)
+                output = pipeline.Stage(encode_sheets(sheet_sessions(sheets, reuse, groups,
+                                                                     joblists, results,
+                                                                     stage_stats), writer),
+                                        maxsize=2, batch_size=1, name="encode")
+                stages.append(output)
+                write = writer.write_encoded
+            else:
+                if jobs > 1 and len(joblist) > 1:
+                    pool = ProcessPoolExecutor(max_workers=jobs)
+                    results = pipeline.ordered_map(parse_sheet, joblist, pool, 2*jobs)
+                else:
+                    results = map(parse_sheet, joblist)
+                output = sheet_sessions(sheets, reuse, groups, joblists, results, stats)
+                write = writer.write
+            for (i, items) in output:
+                with stats.stage("write"):
+                    for item in items:
+                        write(item)
+                stats.count("records emitted", len(items))
+                if incremental:
+                    entries[i]['records'] = len(items)
+    finally:
+        for stage in reversed(stages):
+            stage.close()
+        stats.merge(stage_stats)
+        if pool is not None:
+            pool.shutdown()
+    if incremental:
+        manifest.save(manifest.default_path(json_store), entries, json_store)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingest CSV files generated by TimePolice app')
+    parser.add_argument("csv_list", help="JSON file listing sheets, base dates and columns")
+    parser.add_argument("basedir", help="Directory containing the sheets")
+    parser.add_argument("json_output", help="JSON store to write")
+    parser.add_argument("--jobs", help="Number of worker processes", type=int, default=1,
+                        action='store')
+    parser.add_argument("--format", help="Output layout, default from json_output extension",
+                        choices=jsonstore.FORMATS, action='store')
+    parser.add_argument("--encoding", help="Encoding of the sheets, e.g. {}"
+                        .format(transcode.LENIENT_CP1252), default="utf-8", action='store')
+    parser.add_argument("--incremental", help="Only parse sheets changed since the last "
+                        "incremental run, see json_output.manifest", action='store_true')
+    parser.add_argument("--pipeline", help="Read, parse and encode in separate threads "
+                        "connected by bounded queues", action='store_true')
+    parser.add_argument("--reader", help="csv, or mmap to scan memory mapped sheets on their "
+                        "bytes", choices=['csv', 'mmap'], default='csv', action='store')
+    compression.add_arguments(parser)
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    if args.pipeline and args.jobs > 1:
+        parser.error("--pipeline parses in one thread, use it without --jobs")
+    if args.pipeline and args.reader != 'csv':
+        parser.error("--pipeline reads the sheets as text, use it without --reader mmap")
+    instrument.setup_logging(args.verbose)
+    compression.setup(args.compress_workers)
+    stats = instrument.Stats()
+    with stats.stage("total"):
+        main(args.csv_list, args.basedir, args.json_output, args.jobs, args.format, args.encoding,
+             args.incremental, stats, args.pipeline, args.reader)
+    stats.log_errors(log)
+    stats.log(log)